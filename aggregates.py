@@ -0,0 +1,94 @@
+import heapq
+
+
+class Aggregates:
+    """ Server-wide totals kept up to date as participants change, so reading them doesn't
+        have to walk every participant.
+
+        Like the leaderboard, each balance is a line a + c*t. The total excludes negative
+        balances, so only participants currently above zero are summed, and a heap holds the
+        exact times when someone's balance crosses zero so they can be moved in or out of the
+        sum when the clock gets there. """
+
+    def __init__(self):
+        self._lines: dict[int, tuple[int, int, int]] = {} # user id -> (a, c, cpc)
+        self._versions: dict[int, int] = {}
+        self._next_version = 0
+        self._positive: set[int] = set()
+        self._sum_a = 0
+        self._sum_c = 0
+        self._events: list[tuple[int, int, int]] = []
+        self._time = 0
+        self.total_cps = 0
+        self.total_cpc = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def _zero_crossing_time(self, user_id: int) -> int | None:
+        """ When the participant's balance next crosses zero, or None if it never does """
+        a, c, _ = self._lines[user_id]
+        if user_id in self._positive and c < 0:
+            return -(-a // -c) # first t where a + c*t <= 0
+        if user_id not in self._positive and c > 0:
+            return -a // c + 1 # first t where a + c*t > 0
+        return None
+
+    def _include(self, user_id: int, positive: bool):
+        a, c, _ = self._lines[user_id]
+        if positive and user_id not in self._positive:
+            self._positive.add(user_id)
+            self._sum_a += a
+            self._sum_c += c
+        elif not positive and user_id in self._positive:
+            self._positive.remove(user_id)
+            self._sum_a -= a
+            self._sum_c -= c
+
+    def _schedule(self, user_id: int):
+        t = self._zero_crossing_time(user_id)
+        if t is not None:
+            heapq.heappush(self._events, (max(t, self._time), user_id, self._versions[user_id]))
+
+    def set(self, user_id: int, a: int, c: int, cpc: int):
+        """ Add or update a participant's balance line and CPC. Must be advanced to the current
+            time first. """
+        self.remove(user_id)
+        self._lines[user_id] = (a, c, cpc)
+        self._versions[user_id] = self._next_version
+        self._next_version += 1
+        self.total_cps += c
+        self.total_cpc += cpc
+        self._include(user_id, a + c * self._time > 0)
+        self._schedule(user_id)
+
+        # Outdated events far in the future would otherwise pile up forever
+        if len(self._events) > 2 * len(self._lines) + 64:
+            self._events = []
+            for user_id in self._lines:
+                self._schedule(user_id)
+
+    def remove(self, user_id: int):
+        """ Remove a participant """
+        if user_id not in self._lines:
+            return
+        self._include(user_id, False)
+        _, c, cpc = self._lines.pop(user_id)
+        del self._versions[user_id]
+        self.total_cps -= c
+        self.total_cpc -= cpc
+
+    def advance(self, t: int):
+        """ Move the clock forward to time t, applying every zero crossing that happens by then """
+        while self._events and self._events[0][0] <= t:
+            when, user_id, version = heapq.heappop(self._events)
+            if self._versions.get(user_id) != version:
+                continue # line changed since this was scheduled
+            self._time = when
+            self._include(user_id, user_id not in self._positive)
+            self._schedule(user_id)
+        self._time = max(self._time, t)
+
+    def total(self) -> int:
+        """ Sum of every positive balance at the current time """
+        return self._sum_a + self._sum_c * self._time
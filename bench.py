@@ -0,0 +1,190 @@
+""" Benchmarks for the database and the message makers at synthetic scale.
+
+    python bench.py                                  # 1k, 10k and 100k participants
+    python bench.py --sizes 1000 --out results.json  # save the results
+    python bench.py --baseline results.json          # flag regressions against saved results
+
+    Discord isn't contacted. Users shown on messages come from a stubbed fetch, so only the
+    rendering itself is timed. """
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import database
+from config import USER_CACHE_SIZE, USER_CACHE_TTL, USER_FETCH_CONCURRENCY
+from cookiebot import bot, make_clicker_message, make_upgrades_message
+from database import Database
+from users import UserResolver
+
+
+class FakeUser:
+    """ Stands in for a discord User on rendered messages """
+
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.name = self.display_name = f'user{user_id}'
+        self.mention = f'<@{user_id}>'
+
+
+async def fetch_user(user_id: int) -> FakeUser:
+    """ Stands in for fetching a user from discord """
+    return FakeUser(user_id)
+
+
+def make_population(size: int, seed: int = 0) -> dict:
+    """ Database contents for the given number of participants, in the layout it's stored in
+        on disk. Earlier (cheaper) upgrades are owned by more people and at higher levels.
+        Balances are in proportion to what was spent on upgrades, like they would be in play,
+        so the leaderboard doesn't reorder itself every second. """
+    rng = random.Random(seed)
+    now = int(time.time())
+    cookies = {}
+    settled_times = {}
+    upgrades = {}
+    for i in range(size):
+        user_id = 10 ** 17 + i
+        levels = {}
+        spent = 0
+        for upgrade in bot.upgrades:
+            if rng.random() < 0.9 * 0.75 ** upgrade.id:
+                level = 1 + int(rng.expovariate(1 / (20 * 0.8 ** upgrade.id)))
+                levels[upgrade.id] = min(level, upgrade.max_level)
+                spent += upgrade.get_spent(levels[upgrade.id])
+        if levels:
+            upgrades[user_id] = levels
+        cookies[user_id] = spent * rng.randrange(1, 300) // 100 + rng.randrange(1000)
+        settled_times[user_id] = now - rng.randrange(86400)
+    return {
+        'cookies': cookies,
+        'settled_times': settled_times,
+        'upgrades': upgrades,
+        'last_clicked_user_id': 10 ** 17,
+        'last_clicked_value': 1,
+    }
+
+
+async def timeit(f, repeat: int) -> dict:
+    """ Time a function (sync or async) a number of times, in milliseconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f()
+        if asyncio.iscoroutine(result):
+            await result
+        times.append((time.perf_counter() - start) * 1000)
+    return dict(min_ms=min(times), median_ms=statistics.median(times))
+
+
+async def run_size(size: int, repeat: int, directory: str) -> dict:
+    # Balances keep growing with the clock, and the leaderboard replays whatever overtakes
+    # happened since it was last read. Stop the clock so every repeat times the same work.
+    now = database._now
+    frozen = now()
+    database._now = lambda: frozen
+    try:
+        return await _run_size(size, repeat, directory)
+    finally:
+        database._now = now
+
+
+async def _run_size(size: int, repeat: int, directory: str) -> dict:
+    filepath = os.path.join(directory, f'db-{size}.json')
+    db = Database(filepath)
+    db._from_json(make_population(size))
+    await db.save()
+    db.load()
+    async with db:
+        db.recompute_stats(bot.upgrades)
+    await db.save()
+
+    # Everything the bot renders reads from bot.db
+    bot.db = db
+    bot.user_resolver = UserResolver(lambda user_id: None, fetch_user,
+                                     USER_CACHE_TTL, USER_CACHE_SIZE, USER_FETCH_CONCURRENCY)
+    user = FakeUser(10 ** 17)
+
+    loaded = []
+    def load():
+        loaded.append(Database(filepath))
+        loaded[-1].load()
+
+    async def flush():
+        # Body of the db_saver loop, after a typical burst of writes
+        async with db:
+            for user_id in range(10 ** 17, 10 ** 17 + min(size, 100)):
+                db.add_cookies(user_id, 1)
+        await db.flush()
+
+    results = {'load': await timeit(load, repeat)}
+    for other in loaded:
+        await other.close()
+    results.update({
+        'save': await timeit(db.save, repeat),
+        'get_ranks': await timeit(lambda: db.get_ranks(bot.upgrades, limit=25), repeat),
+        'get_total_cookies': await timeit(db.get_total_cookies, repeat),
+        'db_saver': await timeit(flush, repeat),
+        'make_clicker_message': await timeit(lambda: make_clicker_message(allow_skip=False), repeat),
+        'make_upgrades_message': await timeit(lambda: make_upgrades_message(user), repeat),
+    })
+    await db.close()
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    """ Benchmarks whose median got slower than the baseline by more than the threshold """
+    regressions = []
+    for size, benches in results['results'].items():
+        for name, result in benches.items():
+            base = baseline['results'].get(size, {}).get(name)
+            if base is None or base['median_ms'] <= 0:
+                continue
+            ratio = result['median_ms'] / base['median_ms']
+            if ratio > threshold:
+                regressions.append(f'{name} @ {size}: {base["median_ms"]:.3f}ms -> '
+                                   f'{result["median_ms"]:.3f}ms ({ratio:.2f}x)')
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark the database and message makers')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--out', help='write the results to this json file')
+    parser.add_argument('--baseline', help='json file of earlier results to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown ratio that counts as a regression')
+    args = parser.parse_args()
+
+    results = {
+        'python': platform.python_version(),
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            benches = results['results'][str(size)] = await run_size(size, args.repeat, directory)
+            for name, result in benches.items():
+                print(f'{size:>8} {name:<24} {result["median_ms"]:>10.3f}ms (min {result["min_ms"]:.3f}ms)')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
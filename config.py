@@ -6,16 +6,37 @@ from discord import Object
 GUILD = Object(687146032416555047)
 DEV_GUILD = Object(913924123405729812)
 
-# How fast cookie counts are updated in the db
-COOKIE_UPDATE_RATE = 5
+# How often the database journal is checked for compaction
+DB_SAVE_RATE = 30
+# Size in bytes the database journal can grow to before it is compacted into a new snapshot
+DB_JOURNAL_MAX_SIZE = 1_000_000
 # How fast the clicker/leaderboard message is updated on discord
 DISCORD_UPDATE_RATE = 30
+# Minimum seconds between clicker message edits. Updates requested within this window are merged.
+DISCORD_UPDATE_DEBOUNCE = 2
+# Longest rate limit wait in seconds discord.py sleeps through before raising RateLimited instead
+# (discord.py won't go below 30)
+DISCORD_MAX_RATELIMIT_TIMEOUT = 30
+# How long fetched users (names shown on messages) are cached for, in seconds
+USER_CACHE_TTL = 10 * 60
+# Max number of fetched users kept in the cache
+USER_CACHE_SIZE = 1000
+# Max number of users fetched from discord at the same time
+USER_FETCH_CONCURRENCY = 5
 # Cookie button cooldown
 COOKIE_COOLDOWN = 60
 # Upgrades refresh button cooldown
 REFRESH_COOLDOWN = 120
 # Range of cookies obtainable from the button
 COOKIE_RANGE = (1, COOKIE_COOLDOWN * 3 * 2)
+# Periods /progress shows how much a player actually made over
+GROWTH_PERIODS = [('hour', 60 * 60), ('day', 60 * 60 * 24), ('week', 60 * 60 * 24 * 7)]
+# Amounts of levels the shop can buy at once (besides max)
+BUY_AMOUNTS = [1, 10, 25]
+# Highest level any upgrade can be bought to, unless its price is capped lower. This caps the
+# upgrades without a price cap too (Like Button, Girl Scouts and Blurbot): past it the shop shows
+# MAX. Per-level tables are precomputed up to here, so it also bounds their memory.
+UPGRADE_MAX_LEVEL = 200
 # Percentage of cookies stolen when blue shelled
 SWINDLE_AMOUNT = 0.5
 # Percentage of cookies given away when first place blue shells themselves
@@ -24,6 +45,16 @@ SWINDLE_BACKFIRE_AMOUNT = 0.25
 BIGNUM_PLACES = 3
 # Logger level
 LOG_LEVEL = logging.INFO
+# File game events are logged to, how often they're written, and whether each write is fsynced
+EVENT_LOG_FILE = 'data/events.jsonl'
+EVENT_LOG_FLUSH_RATE = 5
+EVENT_LOG_FSYNC = False
+# Size in bytes the event log can grow to before it's rotated, and how many old logs are kept
+EVENT_LOG_MAX_SIZE = 50_000_000
+EVENT_LOG_BACKUPS = 5
+# Where Prometheus metrics are served, at http://host:port/metrics (set the port to None to turn it off)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9108
 
 COOKIE_QUOTES = [
     "C is for cookie, and cookie is for me.",
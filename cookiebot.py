@@ -1,5 +1,7 @@
+import asyncio
+import importlib
 import random
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from fractions import Fraction
 from io import BytesIO
 from logging.handlers import TimedRotatingFileHandler
@@ -8,9 +10,15 @@ import discord as d
 from discord import User
 from discord.ext import tasks
 
+import catalog
+import metrics
+import profiling
 from config import *
 from database import Database
-from upgrades import ClickUpgrade, PassiveUpgrade, SwindleUpgrade, Upgrade
+from events import EventLog
+from updater import DebouncedUpdater
+from upgrades import Upgrade, fingerprint
+from users import UserResolver
 from util import *
 
 # --- Bot --- #
@@ -25,32 +33,25 @@ log.addHandler(log_handler)
 
 class CookieBot(d.Client):
     def __init__(self):
-        self.db = Database('data/db.json')
-
-        f = 40 # price scale factor
-        L = 30 # level cap
-        shell = '<:blueshell:1222371607784198215>'
-        self.upgrades: list[Upgrade] = [
-            ClickUpgrade  ('👍', 'Facebook Marketplace Like Button', exp(100, 8),            exp(2*100, 8)),
-            ClickUpgrade  ('🧗‍♀️', 'Girl Scouts Ad Campaign',          exp(10**6, 6000),       exp(2*10**6, 6000)),
-            PassiveUpgrade('👨‍🍳', 'Chef Freako',                      exp(1, 1.75),           cap(exp(f*1, 1.75), L)),
-            PassiveUpgrade('🔥', 'Oven Eat the Food',                exp(50, 4),             cap(exp(f*50, 4), L)),
-            PassiveUpgrade('🎤', 'Astley Automator',                 exp(5000, 20),          cap(exp(f*5000, 20), L)),
-            PassiveUpgrade('🛠️', 'Home Depot Bakery',                exp(150000, 75),        cap(exp(f*150000, 75), L)),
-            PassiveUpgrade('🏰', 'Crypto Cookie Castle',             exp(500*10**6, 1500),   cap(exp(f*500*10**6, 1500), L)),
-            PassiveUpgrade('🏗️', 'Cookie Construction Company',      exp(25*10**12, 15000),  cap(exp(f*25*10**12, 15000), L)),
-            PassiveUpgrade('🐢', 'Blurbot ver.1.22474487139...',     lambda l: l+2 if l < 10 else -10**96, lambda _: 69*10**68, hide=True),
-            SwindleUpgrade(shell, 'Blue Shell',                      lin(0.05, 0.025),       cap(exp(10**6, 10**3), 19), hide=True)
-        ]
+        self.db = Database('data/db.json', journal_max_size=DB_JOURNAL_MAX_SIZE)
+
+        self.upgrades: list[Upgrade] = catalog.make_upgrades()
 
         intents = d.Intents.default()
         # intents.message_content = True
         intents.members = True
 
-        super().__init__(intents=intents)
+        super().__init__(intents=intents, max_ratelimit_timeout=DISCORD_MAX_RATELIMIT_TIMEOUT)
         self.tree = d.app_commands.CommandTree(self)
-        self.prev_cookie_count = 0
-        self.prev_cooldown_remaining = 0
+        self.user_resolver = UserResolver(super().get_user, self.fetch_user,
+                                          USER_CACHE_TTL, USER_CACHE_SIZE, USER_FETCH_CONCURRENCY)
+        self.prev_clicker_digest: str | None = None
+        self.buy_amounts: dict[int, int | None] = {} # user id -> levels bought at once (None for max)
+        self.clicker_message_updater = DebouncedUpdater(self.update_clicker_message,
+                                                        DISCORD_UPDATE_RATE, DISCORD_UPDATE_DEBOUNCE)
+        self.metrics_runner = None
+        self.events = EventLog(EVENT_LOG_FILE, EVENT_LOG_FLUSH_RATE, EVENT_LOG_FSYNC,
+                               EVENT_LOG_MAX_SIZE, EVENT_LOG_BACKUPS)
 
     async def on_ready(self):
         log.info(f'Logged in as {self.user}!')
@@ -66,20 +67,57 @@ class CookieBot(d.Client):
             await self.tree.sync(guild=DEV_GUILD)
         log.debug('Commands synced.')
 
+        # Load the database into memory
+        self.db.load()
+        await self.load_upgrades()
+        self.db_saver.start()
+        self.events.start()
+
+        # Serve metrics
+        metrics.PARTICIPANTS.set_function(self.db.get_participant_count)
+        if METRICS_PORT is not None:
+            self.metrics_runner = await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
         # Add persistent views
         async with self.db:
             clicker_msg_id = self.db.get_clicker_message_id()
             self.add_view(CookieClicker(), message_id=clicker_msg_id)
             log.info(f'Added persistent clicker view for message {clicker_msg_id}')
 
-        # Start cookie updater task
-        self.cookie_updater.start()
+    async def load_upgrades(self, reload=False) -> bool:
+        """ Make sure everyone's cached stats match the upgrade config, recomputing all of them
+            at once if it changed. If reload is True, the upgrades are reloaded from catalog.py
+            first. Returns True if the stats were recomputed. """
+        if reload:
+            importlib.reload(catalog)
+        upgrades = catalog.make_upgrades() if reload else self.upgrades
+        new_fingerprint = fingerprint(upgrades)
+        async with self.db:
+            self.upgrades = upgrades
+            if self.db.get_catalog_fingerprint() == new_fingerprint:
+                return False
+            self.db.recompute_stats(upgrades)
+            self.db.set_catalog_fingerprint(new_fingerprint)
+            self.events.emit('recompute_stats', fingerprint=new_fingerprint)
+        log.info('Upgrade config changed, recomputed everyone\'s stats')
+        return True
+
+    async def close(self):
+        # Let a save that's in progress finish before the final one
+        self.db_saver.cancel()
+        task = self.db_saver.get_task()
+        if task is not None:
+            await asyncio.wait([task])
+        self.clicker_message_updater.stop()
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+        await super().close()
+        await self.db.close()
+        await self.events.stop()
+        log.info('Database saved.')
 
     async def get_user(self, id: int, /) -> User:
-        user = super().get_user(id)
-        if user:
-            return user
-        return await self.fetch_user(id)
+        return await self.user_resolver.get(id)
 
     async def get_channel(self, id: int, /) -> d.TextChannel:
         channel = super().get_channel(id)
@@ -99,9 +137,9 @@ class CookieBot(d.Client):
             log.info(f'Updated cookie message to {msg.id}')
 
     async def init_clicker_message(self):
-        async with self.db:
-            channel_id = self.db.get_clicker_channel_id()
-            msg_id = self.db.get_clicker_message_id()
+        with self.db.read() as db:
+            channel_id = db.get_clicker_channel_id()
+            msg_id = db.get_clicker_message_id()
 
         if msg_id is not None:
             try:
@@ -115,45 +153,78 @@ class CookieBot(d.Client):
                     bot.db.set_clicker_message_id(None)
                     bot.db.set_clicker_channel_id(None)
 
-    @tasks.loop(seconds=COOKIE_UPDATE_RATE)
-    async def cookie_updater(self):
-        """ Updates the database cookie count. Does not use discord api. """
-        async with self.db:
-            for user_id in self.db.get_participants_user_ids():
-                cps = self.db.get_cookies_per_second(self.upgrades, user_id)
-                self.db.add_cookies(user_id, cps * COOKIE_UPDATE_RATE)
+    @tasks.loop(seconds=DB_SAVE_RATE)
+    @metrics.timed(metrics.TASK_TICK_SECONDS, task='db_saver')
+    async def db_saver(self):
+        """ Compacts the database journal once it gets too big. Does not use discord api. """
+        await self.db.flush()
 
-    @cookie_updater.before_loop
-    async def before_cookie_updater(self):
-        log.debug(f'Cookie updater started. ({COOKIE_UPDATE_RATE}s)')
+    @db_saver.before_loop
+    async def before_db_saver(self):
+        log.debug(f'Database saver started. ({DB_SAVE_RATE}s)')
 
-    @cookie_updater.after_loop
-    async def after_cookie_updater(self):
-        log.debug('Cookie updater stopped.')
+    @db_saver.after_loop
+    async def after_db_saver(self):
+        log.debug('Database saver stopped.')
 
-    @tasks.loop(seconds=DISCORD_UPDATE_RATE)
-    async def clicker_message_updater(self):
+    @metrics.timed(metrics.TASK_TICK_SECONDS, task='clicker_updater')
+    async def update_clicker_message(self):
+        """ Run by clicker_message_updater. Renders the clicker message from the latest state and
+            edits it if anything changed. """
+        await self.wait_until_ready()
         log.debug('Updating clicker')
         msg = await make_clicker_message()
         if msg is not None:
+            metrics.DISCORD_REQUESTS.inc(kind='clicker_edit')
             try:
                 await self.message.edit(**msg)
+                self.pace_clicker_edits()
             except d.NotFound:
+                metrics.DISCORD_FAILURES.inc(kind='clicker_edit', reason=404)
                 log.warning('Clicker message was deleted!')
                 self.clicker_message_updater.stop()
                 self.message = None
                 async with bot.db:
                     bot.db.set_clicker_channel_id(None)
                     bot.db.set_clicker_message_id(None)
-
-    @clicker_message_updater.before_loop
-    async def before_cookie_updater(self):
-        await self.wait_until_ready()
-        log.debug(f'Clicker message updater started. ({DISCORD_UPDATE_RATE}s)')
-
-    @clicker_message_updater.after_loop
-    async def after_cookie_updater(self):
-        log.debug('Clicker message updater stopped.')
+            except d.RateLimited as e:
+                metrics.DISCORD_FAILURES.inc(kind='clicker_edit', reason=429)
+                log.warning(f'Clicker edit rate limited, backing off {e.retry_after}s')
+                self.clicker_message_updater.back_off(e.retry_after)
+                self.prev_clicker_digest = None # wasn't sent
+            except d.HTTPException as e:
+                metrics.DISCORD_FAILURES.inc(kind='clicker_edit', reason=e.status)
+                if e.status != 429:
+                    raise
+                retry_after = float(e.response.headers.get('Retry-After', DISCORD_UPDATE_RATE))
+                log.warning(f'Clicker edit rate limited, backing off {retry_after}s')
+                self.clicker_message_updater.back_off(retry_after)
+                self.prev_clicker_digest = None # wasn't sent
+
+    def pace_clicker_edits(self):
+        """ Spread the clicker message edits left in the current rate limit window over the
+            rest of it, so updates slow down before discord.py has to wait on a 429 """
+        ratelimit = self.get_edit_ratelimit(self.message)
+        if ratelimit is None:
+            return
+        remaining, reset_after = ratelimit
+        if reset_after > 0:
+            self.clicker_message_updater.back_off(reset_after / (max(remaining, 0) + 1))
+
+    def get_edit_ratelimit(self, msg: d.Message) -> tuple[int, float] | None:
+        """ (edits remaining, seconds until the window resets) of the rate limit on editing the
+            message, as last reported by discord. None if not known yet. discord.py doesn't
+            expose this, so it's read from the same bucket its HTTP client uses. """
+        route = d.http.Route('PATCH', '/channels/{channel_id}/messages/{message_id}',
+                             channel_id=msg.channel.id, message_id=msg.id)
+        try:
+            bucket_hash = self.http._bucket_hashes.get(route.key, route.key)
+            bucket = self.http._buckets.get(f'{bucket_hash}:{route.major_parameters}')
+        except AttributeError:
+            return None # discord.py internals changed
+        if bucket is None or bucket.expires is None:
+            return None
+        return bucket.remaining, bucket.expires - asyncio.get_running_loop().time()
 
 bot = CookieBot()
 
@@ -188,12 +259,13 @@ class CookieClicker(d.ui.View):
             bot.db.set_last_clicked_time()
             bot.db.set_last_clicked_user_id(clicker_user_id)
             bot.db.set_last_clicked_value(num)
+            bot.events.emit('click', user_id=clicker_user_id, value=num, base=base_num)
             log.info(f'Click! {user.name} got {num} cookies')
 
             # Swindling
             swindle = random.random() < bot.db.get_swindle_probability(bot.upgrades, clicker_user_id)
             if swindle:
-                ranks = bot.db.get_ranks(bot.upgrades)
+                ranks = bot.db.get_ranks(bot.upgrades, limit=1)
                 first_cookies, _, first_user_id = ranks[0]
 
                 if clicker_user_id == first_user_id:
@@ -210,6 +282,8 @@ class CookieClicker(d.ui.View):
 
                 bot.db.add_cookies(first_user_id, -num_swindled)
                 bot.db.add_cookies(swindler_user_id, num_swindled)
+                bot.events.emit('swindle', victim_id=first_user_id, swindler_id=swindler_user_id,
+                                amount=num_swindled, backfired=swindler_user_id != clicker_user_id)
 
         # Build and send response
         if cooldown > 0:
@@ -221,7 +295,7 @@ class CookieClicker(d.ui.View):
 
         # Disable button and force leaderboard update
         button.disabled = True
-        bot.clicker_message_updater.restart()
+        bot.clicker_message_updater.request()
 
         # Make cookie quote
         quote = random.choice(COOKIE_QUOTES)
@@ -237,15 +311,16 @@ class CookieClicker(d.ui.View):
                 swindle_quote = random.choice(SWINDLE_BACKFIRE_QUOTES)
 
             # Fill in message template
-            swindled_user = await bot.get_user(first_user_id)
-            swindler_user = await bot.get_user(swindler_user_id)
+            users = await bot.user_resolver.get_many([first_user_id, swindler_user_id])
+            swindled_user = users[first_user_id]
+            swindler_user = users[swindler_user_id]
             swindle_msg = swindle_quote \
                 .replace('{a}', swindled_user.mention) \
                 .replace('{b}', swindler_user.mention) \
                 .replace('{n}', bignum(num_swindled))
 
             # Send
-            await interaction.channel.send(swindle_msg)
+            await discord_request('channel_send', interaction.channel.send(swindle_msg))
 
     @d.ui.button(label='My upgrades', style=d.ButtonStyle.gray, emoji='⬆️', custom_id='upgrades-btn')
     @catch_errors
@@ -264,14 +339,16 @@ class CookieClicker(d.ui.View):
         await interaction.response.send_message(f"{user.mention} {msg['content']}")
 
 class Shop(d.ui.View):
-    def __init__(self, purchase_options: list[d.SelectOption]):
+    def __init__(self, purchase_options: list[d.SelectOption], amount: int | None):
         super().__init__(timeout=None)
         self.add_item(UpgradeSelect(purchase_options))
+        self.add_item(BuyAmountSelect(amount))
 
-    @d.ui.button(label='Refresh', style=d.ButtonStyle.gray, emoji='🔄', row=1)
+    @d.ui.button(label='Refresh', style=d.ButtonStyle.gray, emoji='🔄', row=2)
+    @catch_errors
     async def refresh(self, interaction: d.Interaction, button: d.ui.Button):
         user_id = interaction.user.id
-        async with bot.db:
+        async with bot.db.user(user_id):
             owner_id = bot.db.get_upgrade_message_owner_id(interaction.message.id)
             cooldown = bot.db.get_upgrade_refresh_cooldown_remaining(REFRESH_COOLDOWN, user_id)
             if cooldown == 0:
@@ -279,7 +356,7 @@ class Shop(d.ui.View):
 
         if cooldown == 0 and owner_id == user_id:
             msg = await make_upgrades_message(interaction.user)
-            await interaction.message.edit(**msg)
+            await discord_request('message_edit', interaction.message.edit(**msg))
             await interaction.response.defer()
 
 class UpgradeSelect(d.ui.Select):
@@ -293,27 +370,32 @@ class UpgradeSelect(d.ui.Select):
 
     @catch_errors
     async def callback(self, interaction: d.Interaction):
-        async with bot.db:
-            user_id = bot.db.get_upgrade_message_owner_id(interaction.message.id)
+        with bot.db.read() as db:
+            user_id = db.get_upgrade_message_owner_id(interaction.message.id)
 
-            # If the message isn't saved, just don't respond
-            if user_id is None:
-                return
+        # If the message isn't saved, just don't respond
+        if user_id is None:
+            return
 
+        async with bot.db.user(user_id):
             # Check that this user owns the message
             if user_id != interaction.user.id:
                 raise Break()
 
             upgrade_id = int(self.values[0])
             upgrade = bot.upgrades[upgrade_id]
-            level = bot.db.get_upgrade_level(user_id, upgrade_id) + 1
-            price = upgrade.get_price(level)
+            level = bot.db.get_upgrade_level(user_id, upgrade_id)
             balance = bot.db.get_cookies(user_id)
+            n = self.get_buy_count(upgrade, level, balance, bot.buy_amounts.get(user_id, 1))
+            price = upgrade.get_bulk_price(level, n)
+            level += max(n, 1)
 
-            # Level up!
-            if balance >= price:
+            # Level up! All the levels are bought at once.
+            if price is not None and balance >= price:
                 bot.db.set_upgrade_level(bot.upgrades, user_id, upgrade_id, level)
                 bot.db.add_cookies(user_id, -price)
+                bot.events.emit('purchase', user_id=user_id, upgrade_id=upgrade_id, level=level,
+                                levels=n, price=price)
 
         # Build and send response
         if user_id != interaction.user.id:
@@ -325,7 +407,13 @@ class UpgradeSelect(d.ui.Select):
             )
             return
 
-        if balance < price:
+        if price is None:
+            # maxed out
+            await interaction.response.send_message(
+                "That upgrade all maxed out! Me no have any more of it.",
+                ephemeral=True
+            )
+        elif balance < price:
             # can't afford
             await interaction.response.send_message(
                 "Hey!! You no have enough cookie for that!",
@@ -333,24 +421,35 @@ class UpgradeSelect(d.ui.Select):
             )
         else:
             # success
+            levels_str = f' ({n} levels)' if n > 1 else ''
             await interaction.response.send_message(
-                f'Purchased **{upgrade.name} {roman(level)}**!\nThank for the cookies!! nom nom nom',
+                f'Purchased **{upgrade.name} {roman(level)}**{levels_str}!\nThank for the cookies!! nom nom nom',
                 ephemeral=True
             )
 
         # Edit original message (to remove selected option)
         msg = await make_upgrades_message(interaction.user)
-        await interaction.message.edit(**msg)
+        await discord_request('message_edit', interaction.message.edit(**msg))
 
     @staticmethod
-    def get_options(upgrade_levels: list[int]) -> list[d.SelectOption]:
+    def get_buy_count(upgrade: Upgrade, level: int, balance: int, amount: int | None) -> int:
+        """ How many levels to buy at once (0 if the upgrade is maxed). Buying max buys as many
+            as the balance affords, or 1 if it can't afford any so the price can still be shown. """
+        if amount is None:
+            amount = max(upgrade.get_max_affordable(level, balance), 1)
+        return max(0, min(amount, upgrade.max_level - level))
+
+    @staticmethod
+    def get_options(upgrade_levels: list[int], amount: int | None, balance: int) -> list[d.SelectOption]:
         options = []
         for upgrade, level in zip(bot.upgrades, upgrade_levels):
-            price = bignum(upgrade.get_price(level + 1))
-            value = upgrade.get_value_str(level + 1, hide=True)
+            n = UpgradeSelect.get_buy_count(upgrade, level, balance, amount)
+            price = upgrade.get_bulk_price(level, n)
+            price = bignum(price) if price is not None else 'MAX'
+            value = upgrade.get_value_str(level + max(n, 1), hide=True)
 
             options.append(d.SelectOption(
-                label=f'{upgrade.id + 1}. {upgrade.name} {roman(level + 1)}',
+                label=f'{upgrade.id + 1}. {upgrade.name} {roman(level + max(n, 1))}',
                 description=f'🍪 {price} ⬆️ {value}',
                 emoji=upgrade.emoji,
                 value=upgrade.id
@@ -358,57 +457,79 @@ class UpgradeSelect(d.ui.Select):
 
         return options
 
+class BuyAmountSelect(d.ui.Select):
+    def __init__(self, amount: int | None):
+        options = [
+            d.SelectOption(label=f'Buy {n}', value=str(n), default=n == amount)
+            for n in BUY_AMOUNTS
+        ]
+        options.append(d.SelectOption(label='Buy max', value='max', default=amount is None))
+        super().__init__(
+            custom_id='buy-amount-select',
+            options=options,
+            row=1
+        )
 
-# --- Complex message makers --- #
+    @catch_errors
+    async def callback(self, interaction: d.Interaction):
+        with bot.db.read() as db:
+            owner_id = db.get_upgrade_message_owner_id(interaction.message.id)
 
-async def make_clicker_message(allow_skip=True) -> dict | None:
-    async with bot.db:
-        total_cookies = bot.db.get_total_cookies()
-        cooldown = bot.db.get_cooldown_remaining(COOKIE_COOLDOWN)
+        # Only the owner of the message can change it
+        if owner_id != interaction.user.id:
+            await interaction.response.defer()
+            return
 
-        if allow_skip:
-            # Don't update the message if nothing has changed (cookie count is the
-            # same AND the cooldown did not expire)
-            if total_cookies == bot.prev_cookie_count and cooldown == bot.prev_cooldown_remaining:
-                log.debug('Skipping update')
-                return None
+        value = self.values[0]
+        bot.buy_amounts[owner_id] = None if value == 'max' else int(value)
+        await interaction.response.edit_message(**await make_upgrades_message(interaction.user))
 
-        # Update prev counts
-        bot.prev_cookie_count = total_cookies
-        bot.prev_cooldown_remaining = cooldown
+
+# --- Complex message makers --- #
+
+async def make_clicker_message(allow_skip=True) -> dict | None:
+    with bot.db.read() as db:
+        cooldown = db.get_cooldown_remaining(COOKIE_COOLDOWN)
+        ranks = db.get_ranks(bot.upgrades, limit=25)
+        total_cookies = db.get_total_cookies()
 
         # Last clicked
-        last_clicked_user_id = bot.db.get_last_clicked_user_id()
-        last_clicked_value = bot.db.get_last_clicked_value()
-        last_clicked_time = bot.db.get_last_clicked_time()
+        last_clicked_user_id = db.get_last_clicked_user_id()
+        last_clicked_value = db.get_last_clicked_value()
+        last_clicked_time = db.get_last_clicked_time()
 
-        # Leaderboard
-        participants = bot.db.get_participants_user_ids()
-        ranks = bot.db.get_ranks(bot.upgrades)
+    # Look up everyone shown on the message at once
+    leaderboard = [user_id for _, _, user_id in ranks]
+    user_ids = leaderboard if last_clicked_user_id is None else [last_clicked_user_id, *leaderboard]
+    users = await bot.user_resolver.get_many(user_ids)
 
     # Total cookie count display
     content = f'# 🍪 {bignum(total_cookies)}'
 
-    # Last clicked
+    # Last clicked. Times are shown with discord timestamps, so they count by themselves
+    # without the message being edited.
+    last_clicked_time = last_clicked_time.replace(tzinfo=timezone.utc)
     if last_clicked_user_id is not None:
-        last_clicked_user = await bot.get_user(last_clicked_user_id)
-        last_clicked_ago = int((datetime.utcnow() - last_clicked_time).total_seconds())
-        content += f'\n👆 **+{bignum(last_clicked_value)}** - {last_clicked_user.display_name} {time_str(last_clicked_ago)} ago'
+        last_clicked_user = users[last_clicked_user_id]
+        last_clicked_ago = d.utils.format_dt(last_clicked_time, 'R')
+        content += f'\n👆 **+{bignum(last_clicked_value)}** - {last_clicked_user.display_name} {last_clicked_ago}'
 
     # View and cookie button
     view = CookieClicker()
     if cooldown > 0:
         view.button.disabled = True
-        view.button.label = f'{time_str(cooldown)} ...'
+        view.button.label = 'Baking...'
+        ready_time = d.utils.format_dt(last_clicked_time + timedelta(seconds=COOKIE_COOLDOWN), 'R')
+        content += f'\n⏲️ More cookie ready {ready_time}'
 
     # Leaderboard embed
-    if len(participants) == 0:
+    if len(ranks) == 0:
         embed = None
     else:
         embed = d.Embed(color=d.Color.blue())
         embed.set_footer(text=f'updates every {time_str(DISCORD_UPDATE_RATE)}')
-        for i, (cookies, cps, user_id) in enumerate(ranks[:25], 1):
-            user = await bot.get_user(user_id)
+        for i, (cookies, cps, user_id) in enumerate(ranks, 1):
+            user = users[user_id]
             name = user.display_name
             if i == 1:
                 name = '🥇 ' + name
@@ -420,19 +541,28 @@ async def make_clicker_message(allow_skip=True) -> dict | None:
                 name = f'{i}. {name}'
             embed.add_field(name=name, value=f'🍪 {bignum(cookies)}\n+{bignum(cps)} / sec', inline=True)
 
-    return dict(
+    msg = dict(
         content=content,
         view=view,
         embed=embed
     )
 
+    # Don't edit the message if it would look exactly the same
+    digest = payload_digest(**msg)
+    if allow_skip and digest == bot.prev_clicker_digest:
+        log.debug('Skipping update')
+        return None
+    bot.prev_clicker_digest = digest
+    return msg
+
 async def make_upgrades_message(user: d.User | d.Member) -> dict:
     user_id = user.id
-    async with bot.db:
-        balance = bot.db.get_cookies(user_id)
-        cpc = bot.db.get_cookies_per_click(bot.upgrades, user_id)
-        cps = bot.db.get_cookies_per_second(bot.upgrades, user_id)
-        levels = bot.db.get_upgrade_levels(bot.upgrades, user_id)
+    with bot.db.read() as db:
+        balance = db.get_cookies(user_id)
+        cpc = db.get_cookies_per_click(bot.upgrades, user_id)
+        cps = db.get_cookies_per_second(bot.upgrades, user_id)
+        levels = db.get_upgrade_levels(bot.upgrades, user_id)
+        owners = [db.get_owner_count(upgrade.id) for upgrade in bot.upgrades]
 
     # Cookie balance
     content = f'## 🍪 {bignum(balance)}\n{user.mention}'
@@ -449,16 +579,20 @@ async def make_upgrades_message(user: d.User | d.Member) -> dict:
         level = levels[upgrade.id]
         name = f'{upgrade.id + 1}. {upgrade.emoji} {upgrade.name} {roman(level)}'
         desc = upgrade.get_description(level)
-        price = bignum(upgrade.get_price(level + 1))
+        price = upgrade.get_price(level + 1)
+        price = bignum(price) if price is not None else 'MAX'
+        n = owners[upgrade.id]
+        owned = '1 player owns this' if n == 1 else f'{n} players own this'
 
         embed.add_field(
             name=name,
-            value=f'{desc}\nCost: 🍪 {price}',
+            value=f'{desc}\nCost: 🍪 {price}\n👥 {owned}',
             inline=True
         )
 
     # Upgrade selector view
-    view = Shop(UpgradeSelect.get_options(levels))
+    amount = bot.buy_amounts.get(user_id, 1)
+    view = Shop(UpgradeSelect.get_options(levels, amount, balance), amount)
 
     return dict(
         content=content,
@@ -467,10 +601,20 @@ async def make_upgrades_message(user: d.User | d.Member) -> dict:
     )
 
 async def make_progess_message(user: d.User) -> dict:
-    async with bot.db:
-        cookies = bot.db.get_cookies(user.id)
-        cps = bot.db.get_cookies_per_second(bot.upgrades, user.id)
-        ranks = bot.db.get_ranks(bot.upgrades)
+    with bot.db.read() as db:
+        cookies = db.get_cookies(user.id)
+        cps = db.get_cookies_per_second(bot.upgrades, user.id)
+        growth = [db.get_balance_growth(user.id, seconds) for _, seconds in GROWTH_PERIODS]
+        i = db.get_rank(user.id)
+        if i is not None:
+            above = db.get_next_overtake(user.id)
+            below = db.get_next_overtaken(user.id)
+            if above is not None:
+                cookies2 = db.get_cookies(above[0])
+
+    # Look up the players right above and below at once
+    user_ids = [] if i is None else [other[0] for other in (above, below) if other is not None]
+    users = await bot.user_resolver.get_many(user_ids)
 
     # Time to reach 1 googol
     if cookies > 10 ** 100:
@@ -500,15 +644,23 @@ async def make_progess_message(user: d.User) -> dict:
             msg += (' Too long... Me no want to wait that long, you that patient? '
                     'You should make cookie faster!')
 
-    # Find this user's rank
-    msg += '\n\n'
-    for i, (_, _, user_id) in enumerate(ranks):
-        if user_id == user.id:
+    # How much this user actually made recently, with clicks, purchases and swindles
+    made = []
+    for (name, seconds), g in zip(GROWTH_PERIODS, growth):
+        if g is None or g[1] == 0:
             break
-    else:
-        i = -1
+        cookies_made, span = g
+        if span < seconds:
+            # Me no remember that far back yet
+            made.append(f'**🍪 {bignum(cookies_made)}** in the last {time_str(span)}')
+            break
+        made.append(f'**🍪 {bignum(cookies_made)}** in the last {name}')
+    if made:
+        msg += f"\nMe been watching! You made {', '.join(made)}."
 
-    if i == -1:
+    # This user's rank
+    msg += '\n\n'
+    if i is None:
         # Not participating
         msg += "Make some cookies to get on the leaderboard!"
     elif i == 0:
@@ -516,16 +668,21 @@ async def make_progess_message(user: d.User) -> dict:
         msg += "🏆 You're in first place! Me and everyone else very proud of you."
     else:
         # Time to overtake the next player
-        cookies2, cps2, user_id2 = ranks[i - 1]
-        user2 = await bot.get_user(user_id2)
+        user_id2, seconds = above
+        user2 = users[user_id2]
         cookie_diff = cookies2 - cookies + 1
         msg += (f"You're in **{i + 1}{num_suffix(i + 1)}** place! You need **🍪 {bignum(cookie_diff)}** "
                 f"to overtake **{user2.display_name}** for {i}{num_suffix(i)} place!")
-        if cps > 0:
-            seconds = cookie_diff // cps
-            msg += f" At **+{bignum(cps)} / sec**, it'll take only **{time_str(seconds)}** to get that many cookies!"
+        if seconds is not None:
+            msg += f" At **+{bignum(cps)} / sec**, you'll pass them in only **{time_str(seconds)}**!"
         msg += " Keep going!"
 
+    # Time until the player behind overtakes this user
+    if i is not None and below is not None and below[1] is not None:
+        user_id3, seconds = below
+        user3 = users[user_id3]
+        msg += f"\nWatch out! **{user3.display_name}** will overtake you in **{time_str(seconds)}**!"
+
     return dict(content=msg)
 
 
@@ -541,8 +698,8 @@ async def hello(interaction: d.Interaction):
 @catch_errors
 async def jar(interaction: d.Interaction):
     """ how many cookies in your jar """
-    async with bot.db:
-        cookies = bot.db.get_cookies(interaction.user.id)
+    with bot.db.read() as db:
+        cookies = db.get_cookies(interaction.user.id)
 
     if cookies < 0:
         msg = f"{interaction.user.mention} Me no believe it! You eat more cookie than you have? How?!"
@@ -571,6 +728,43 @@ async def progress(interaction: d.Interaction):
     msg = await make_progess_message(interaction.user)
     await interaction.response.send_message(**msg)
 
+@bot.tree.command()
+@catch_errors
+async def stats(interaction: d.Interaction):
+    """ cookie stats for everyone """
+    with bot.db.read() as db:
+        participants = db.get_participant_count()
+        total_cookies = db.get_total_cookies()
+        total_cps = db.get_total_cookies_per_second()
+        total_cpc = db.get_total_cookies_per_click()
+        median, p90, p99 = db.get_cookie_percentiles([50, 90, 99])
+        histogram = db.get_cookie_histogram()
+
+    embed = d.Embed(color=d.Color.blue())
+    embed.title = 'Cookie stats'
+    embed.description = (f'👥 **{participants}** cookie eaters\n'
+                         f'🍪 **{bignum(total_cookies)}** cookies\n'
+                         f'👆 **+{bignum(total_cpc)} / click**\n'
+                         f'🕙 **+{bignum(total_cps)} / sec**')
+
+    if participants > 0:
+        embed.add_field(
+            name='Cookie jars',
+            value=f'Median: 🍪 {bignum(median)}\nTop 10%: 🍪 {bignum(p90)}\nTop 1%: 🍪 {bignum(p99)}',
+            inline=False
+        )
+        biggest = max(count for _, count in histogram)
+        lines = []
+        for bound, count in histogram:
+            if count == 0:
+                continue
+            label = '≤ 0' if bound == 0 else f'{bignum(bound)}+'
+            bar = '█' * max(1, round(count / biggest * 10))
+            lines.append(f'`{label:<16}` {bar} {count}')
+        embed.add_field(name='Distribution', value='\n'.join(lines), inline=False)
+
+    await interaction.response.send_message(embed=embed)
+
 
 # --- Dev commands --- #
 
@@ -589,7 +783,7 @@ async def clicker(interaction: d.Interaction, channel_id: str):
         return
 
     msg_data = await make_clicker_message(allow_skip=False)
-    msg: d.Message = await channel.send(**msg_data)
+    msg: d.Message = await discord_request('channel_send', channel.send(**msg_data))
     await bot.set_clicker_message(msg)
     await interaction.response.send_message(f'New clicker message sent in #{channel}')
 
@@ -598,8 +792,9 @@ async def clicker(interaction: d.Interaction, channel_id: str):
 async def set_cookies(interaction: d.Interaction, user: d.Member, cookies: str):
     """ [Dev] set cookies for a given user """
     cookies = int(cookies)
-    async with bot.db:
+    async with bot.db.user(user.id):
         bot.db.set_cookies(user.id, cookies)
+        bot.events.emit('dev_set_cookies', user_id=user.id, cookies=cookies)
     await interaction.response.send_message(f'set {user} cookies to {cookies}')
 
 @bot.tree.command(guild=DEV_GUILD)
@@ -610,11 +805,12 @@ async def give_upgrade(interaction: d.Interaction, user: d.Member, upgrade_id: i
         await interaction.response.send_message('invalid upgrade id')
         return
 
-    async with bot.db:
+    async with bot.db.user(user.id):
         if level is None:
             level = bot.db.get_upgrade_level(user.id, upgrade_id) + 1
         level = max(level, 0)
         bot.db.set_upgrade_level(bot.upgrades, user.id, upgrade_id, level)
+        bot.events.emit('dev_give_upgrade', user_id=user.id, upgrade_id=upgrade_id, level=level)
 
     upgrade = bot.upgrades[upgrade_id]
     await interaction.response.send_message(f'set {upgrade_id} ({upgrade.name}) for {user} to lv.{level}')
@@ -623,12 +819,18 @@ async def give_upgrade(interaction: d.Interaction, user: d.Member, upgrade_id: i
 @catch_errors
 async def reset(interaction: d.Interaction, user: d.Member | None = None):
     """ [Dev] reset all data for a given user, or everyone if a user is not provided """
-    async with bot.db:
-        user_ids = [user.id] if user else bot.db.get_participants_user_ids()
-        for user_id in user_ids:
-            bot.db.delete_participant(user_id)
-        bot.db.set_last_clicked_user_id(None)
-        bot.db.set_last_clicked_value(0)
+    if user is not None:
+        # Also clears the last click if it was theirs
+        async with bot.db.user(user.id):
+            bot.db.delete_participant(user.id)
+            bot.events.emit('dev_reset', user_id=user.id)
+    else:
+        async with bot.db:
+            for user_id in bot.db.get_participants_user_ids():
+                bot.db.delete_participant(user_id)
+            bot.db.set_last_clicked_user_id(None)
+            bot.db.set_last_clicked_value(0)
+            bot.events.emit('dev_reset', user_id=None)
     await interaction.response.send_message(f"reset {user or 'everyone'}")
 
 @bot.tree.command(guild=DEV_GUILD)
@@ -642,17 +844,27 @@ async def clear_upgrade_message_storage(interaction: d.Interaction):
 @bot.tree.command(guild=DEV_GUILD)
 @catch_errors
 async def clear_cached_cpc_cps(interaction: d.Interaction):
-    """ [Dev] clear cpc & cps cache. Only necessary if upgrade config changes """
+    """ [Dev] recompute everyone's cpc & cps. Happens automatically when upgrade config changes """
     async with bot.db:
-        bot.db.clear_cpc_cps_caches()
-    await interaction.response.send_message('cpc & cps cache cleared')
+        bot.db.recompute_stats(bot.upgrades)
+        bot.events.emit('recompute_stats', fingerprint=bot.db.get_catalog_fingerprint())
+    await interaction.response.send_message('cpc & cps recomputed')
+
+@bot.tree.command(guild=DEV_GUILD)
+@catch_errors
+async def reload_upgrades(interaction: d.Interaction):
+    """ [Dev] reload the upgrade config from catalog.py without restarting """
+    if await bot.load_upgrades(reload=True):
+        await interaction.response.send_message('upgrades reloaded, cpc & cps recomputed')
+    else:
+        await interaction.response.send_message('upgrades reloaded, nothing changed')
 
 @bot.tree.command(guild=DEV_GUILD)
 @catch_errors
 async def print_db(interaction: d.Interaction):
     """ [Dev] print the entire database """
-    async with bot.db:
-        j = bot.db.get_json()
+    with bot.db.read() as db:
+        j = db.get_json()
     if len(j) > 1990:
         file = BytesIO()
         file.write(j.encode('utf-8'))
@@ -662,6 +874,24 @@ async def print_db(interaction: d.Interaction):
     else:
         await interaction.response.send_message(f"```\n{j}\n```")
 
+@bot.tree.command(guild=DEV_GUILD)
+@catch_errors
+async def profile(interaction: d.Interaction, seconds: d.app_commands.Range[int, 1, 600] = 30,
+                  cpu: bool = True, memory: bool = False):
+    """ [Dev] profile cpu (cProfile) and/or memory (tracemalloc) under live traffic for some seconds """
+    if not cpu and not memory:
+        raise InteractionResponse('nothing to profile')
+    if profiling.is_active():
+        raise InteractionResponse('already profiling')
+
+    await interaction.response.defer(thinking=True)
+    report = await profiling.capture(seconds, cpu=cpu, memory=memory)
+    file = BytesIO()
+    file.write(report.encode('utf-8'))
+    file.seek(0)
+    fn = f'profile_{datetime.utcnow().isoformat()}.txt'
+    await interaction.followup.send(file=d.File(file, filename=fn))
+
 @bot.tree.command(guild=DEV_GUILD)
 @catch_errors
 async def kill(interaction: d.Interaction):
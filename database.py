@@ -1,60 +1,511 @@
 import asyncio
 import json
-import math
+import os
+import tempfile
+import time
+from array import array
 from datetime import datetime
+from typing import TextIO
 
+import metrics
+from aggregates import Aggregates
+from history import History
+from leaderboard import Leaderboard
+from ownership import Ownership
 from upgrades import Upgrade
-from util import Break
+from util import Break, uncancellable
 
 _1970 = datetime(1970, 1, 1).isoformat()
 
 
+def _now() -> int:
+    """ Current unix time in whole seconds, which is what balances accrue by """
+    return int(time.time())
+
+
+class Participant:
+    """ Everything stored about a single participant. Cookies is the base amount passive income
+        accrues on top of since the settled time. Levels are indexed by upgrade id. CPC, CPS,
+        swindle probability and the amount invested are derived from the levels, and are None
+        until they're computed (only CPC and CPS are saved). """
+    __slots__ = ('cookies', 'settled', 'levels', 'cpc', 'cps', 'swindle', 'invested')
+
+    def __init__(self, cookies: int = 0, settled: int = 0):
+        self.cookies = cookies
+        self.settled = settled
+        self.levels = array('I')
+        self.cpc: int | None = None
+        self.cps: int | None = None
+        self.swindle: float | None = None
+        self.invested: int | None = None
+
+    def get_level(self, upgrade_id: int) -> int:
+        """ Level of a specific upgrade """
+        if upgrade_id < len(self.levels):
+            return self.levels[upgrade_id]
+        return 0
+
+    def set_level(self, upgrade_id: int, level: int):
+        """ Set the level of a specific upgrade """
+        if upgrade_id >= len(self.levels):
+            self.levels.extend([0] * (upgrade_id + 1 - len(self.levels)))
+        self.levels[upgrade_id] = level
+
+
+class DatabaseView:
+    """ Read-only access to the database, from Database.read(). It doesn't take the write lock
+        or commit anything, so reads never wait behind writes. Everything lives in memory and
+        writes are applied between awaits, so as long as nothing is awaited inside the with
+        block, every read sees the same consistent state. """
+
+    def __init__(self, db: 'Database'):
+        self._db = db
+        self._open = False
+
+    def __enter__(self):
+        self._open = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._open = False
+
+    def __getattr__(self, name: str):
+        if not name.startswith(('get_', 'is_', 'does_')):
+            raise AttributeError(f"'{name}' can't be used from a read-only view of the database")
+        if not self._open:
+            raise RuntimeError('read-only view of the database used outside of its with block')
+        return getattr(self._db, name)
+
+
+class UserTransaction:
+    """ Transaction that only touches a single user's balance and upgrades, from
+        Database.user(). Transactions for different users run at the same time, and only wait
+        for each other when they're for the same user or when a global `async with bot.db`
+        transaction is running. """
+
+    def __init__(self, db: 'Database', user_id: int):
+        self._db = db
+        self._user_id = user_id
+        self._entered = False
+        self._acquired = 0.0
+
+    async def __aenter__(self):
+        db = self._db
+        task = asyncio.current_task()
+        if db._owner is task or db._user_owners.get(task) == self._user_id:
+            return # already inside a transaction that covers this user
+        if task in db._user_owners:
+            raise RuntimeError("can't lock more than one user at a time, use a global transaction")
+        start = time.perf_counter()
+
+        # Wait for any global transaction to finish, and keep new ones out until this is done
+        async with db._lock:
+            db._shared += 1
+            db._no_shared.clear()
+
+        entry = db._user_locks.setdefault(self._user_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._release(entry)
+            raise
+        db._user_owners[task] = self._user_id
+        self._entered = True
+        self._acquired = time.perf_counter()
+        metrics.DB_LOCK_WAIT_SECONDS.observe(self._acquired - start, transaction='user')
+        if db._data is None:
+            db.load()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if not self._entered:
+            return
+        db = self._db
+        db.commit()
+        del db._user_owners[asyncio.current_task()]
+        entry = db._user_locks[self._user_id]
+        entry[0].release()
+        self._release(entry)
+        self._entered = False
+        metrics.DB_LOCK_HOLD_SECONDS.observe(time.perf_counter() - self._acquired, transaction='user')
+        return isinstance(exc_val, Break)
+
+    def _release(self, entry: list):
+        db = self._db
+        entry[1] -= 1
+        if entry[1] == 0:
+            del db._user_locks[self._user_id]
+        db._shared -= 1
+        if db._shared == 0:
+            db._no_shared.set()
+
+
 class Database:
-    def __init__(self, filepath: str):
+    def __new__(cls, filepath: str, *args, backend: str = 'json', **kwargs):
+        """ Pass backend='sqlite' to get a database stored in SQLite instead of a json file """
+        if cls is Database and backend == 'sqlite':
+            from sqlite_database import SQLiteDatabase
+            cls = SQLiteDatabase
+        elif backend not in ('json', 'sqlite'):
+            raise ValueError(f'unknown database backend: {backend}')
+        return super().__new__(cls)
+
+    def __init__(self, filepath: str, journal_max_size: int = 1_000_000, backend: str = 'json'):
         self._filepath = filepath
+        self._journal_filepath = filepath + '.journal'
+        self._journal_max_size = journal_max_size
         self._data: dict | None = None
+        self._users: dict[int, Participant] = {}
         self._lock = asyncio.Lock()
+        self._owner: asyncio.Task | None = None
+        self._depth = 0
+        self._acquired = 0.0
+        self._user_locks: dict[int, list] = {} # user id -> [lock, number of tasks using it]
+        self._user_owners: dict[asyncio.Task, int] = {}
+        self._shared = 0
+        self._no_shared = asyncio.Event()
+        self._no_shared.set()
+        self._journal: TextIO | None = None
+        self._pending: list[str] = []
+        self._replaying = False
+        self._save_lock = asyncio.Lock()
+        self._leaderboard: Leaderboard | None = None
+        self._aggregates: Aggregates | None = None
+        self._ownership: Ownership | None = None
+        self._history = History() # not part of the indexes, it outlives rebuilds
+        self._journal_tail: list[str] | None = None
 
     # --- IO --- #
 
     async def __aenter__(self):
-        if self._data is None: # ignore nested withs
-            await self._lock.acquire()
+        task = asyncio.current_task()
+        if self._owner is task:
+            self._depth += 1
+            return # ignore nested withs
+        if task in self._user_owners:
+            raise RuntimeError("can't start a global transaction inside a user transaction")
+        start = time.perf_counter()
+        await self._lock.acquire()
+        try:
+            await self._no_shared.wait() # user transactions still running
+        except BaseException:
+            self._lock.release()
+            raise
+        self._owner = task
+        self._depth = 1
+        self._acquired = time.perf_counter()
+        metrics.DB_LOCK_WAIT_SECONDS.observe(self._acquired - start, transaction='global')
+        if self._data is None:
             self.load()
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self._data is not None:
-            if exc_type is None or isinstance(exc_val, Break):
-                self.save()
-            self._data = None
+        if self._owner is asyncio.current_task():
+            self._depth -= 1
+            if self._depth > 0:
+                return
+            # Changes were already made in memory, so they're journaled even if there was an
+            # error, otherwise the journal would disagree with the next snapshot.
+            self.commit()
+            self._owner = None
             self._lock.release()
+            metrics.DB_LOCK_HOLD_SECONDS.observe(time.perf_counter() - self._acquired, transaction='global')
             return isinstance(exc_val, Break)
 
-    def save(self):
-        """ Save the database to the file """
-        with open(self._filepath, 'w+') as f:
-            f.write(json.dumps(self._data, indent=4))
+    def user(self, user_id: int) -> UserTransaction:
+        """ Transaction for changes that only touch the given user's balance and upgrades, to use
+            as `async with bot.db.user(user_id)`. Anything involving other users or the clicker
+            state (last click, swindles, message ids) needs a global `async with bot.db`. """
+        return UserTransaction(self, user_id)
 
+    def read(self) -> DatabaseView:
+        """ Read-only view of the database to use as `with bot.db.read() as db`. Don't await
+            anything inside the with block. """
+        if self._data is None:
+            self.load()
+        return DatabaseView(self)
+
+    def _record(self, op: str, *args):
+        """ Queue a mutation to be appended to the journal when the transaction ends """
+        if self._replaying:
+            return
+        self._data['journal_seq'] += 1
+        record = [self._data['journal_seq'], op, *args]
+        self._pending.append(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def _replay(self, op: str, *args):
+        """ Apply a journal record to the data without journaling it again """
+        if op == 'set_upgrade_level':
+            # The upgrade list isn't available here, so the new caches are part of the record
+            user_id, upgrade_id, level, *caches = args
+            p = self._participant(user_id)
+            p.set_level(upgrade_id, level)
+            p.cpc, p.cps = caches or (None, None)
+            p.swindle = p.invested = None
+        elif op == 'settle':
+            self._settle(*args)
+        elif op == 'set_stats':
+            user_id, cpc, cps = args
+            p = self._participant(user_id)
+            p.cpc, p.cps = cpc, cps
+            p.swindle = p.invested = None
+        elif op == 'clear_cpc_cps_caches':
+            # Written by older versions, right after settling everyone. Those settle records
+            # come first in the journal, so only the caches are left to drop.
+            for p in self._users.values():
+                p.cpc = p.cps = p.swindle = p.invested = None
+        elif op in ('set_last_clicked_time', 'set_upgrade_refresh_time'):
+            *args, timestamp = args
+            getattr(self, op)(*args, datetime.fromisoformat(timestamp))
+        else:
+            getattr(self, op)(*args)
+
+    @property
+    def dirty(self) -> bool:
+        """ True if there are journaled changes that aren't in the snapshot file yet """
+        return self._journal is not None and self._journal.tell() > 0
+
+    def commit(self):
+        """ Append all queued mutations to the journal """
+        if not self._pending:
+            return
+        lines = ''.join(self._pending)
+        self._journal.write(lines)
+        self._journal.flush()
+        metrics.DB_WRITTEN_BYTES.inc(len(lines), file='journal') # json is all ascii
+        if self._journal_tail is not None:
+            self._journal_tail.extend(self._pending)
+        self._pending.clear()
+
+    async def flush(self, force=False):
+        """ Commit queued mutations, then compact the journal into a new snapshot if it has
+            grown past the size limit (or if forced and there is anything to compact) """
+        if self._journal is None:
+            return
+        self.commit()
+        if self._journal.tell() >= self._journal_max_size or (force and self.dirty):
+            await self.save()
+
+    @metrics.timed(metrics.DB_SAVE_SECONDS)
+    async def save(self):
+        """ Save a full snapshot of the database to the file and empty the journal. The
+            snapshot is serialized and written in a worker thread, so transactions can keep
+            going while it's being saved. """
+        async with self._save_lock:
+            self.commit()
+            data = self._to_json()
+            # Keep track of what gets committed while the snapshot is being written, since
+            # that's all the new journal should contain
+            self._journal_tail = []
+            try:
+                # A worker thread can't be stopped, so if this is cancelled the lock is still
+                # held until it's done writing. The journal is left as is then, which is safe
+                # since replaying skips what the snapshot already has.
+                await uncancellable(asyncio.to_thread(self._write_snapshot, data))
+                self._rewrite_journal(self._journal_tail)
+            finally:
+                self._journal_tail = None
+
+    def _to_json(self) -> dict:
+        """ The data in the layout it's stored in on disk. This is a new copy, so it can be
+            serialized from another thread. """
+        data = dict(self._data)
+        data['upgrade_message_owner_ids'] = {
+            str(message_id): user_id
+            for message_id, user_id in self._data['upgrade_message_owner_ids'].items()
+        }
+        data['upgrade_refresh_times'] = {
+            str(user_id): timestamp
+            for user_id, timestamp in self._data['upgrade_refresh_times'].items()
+        }
+        cookies = data['cookies'] = {}
+        settled_times = data['settled_times'] = {}
+        upgrades = data['upgrades'] = {}
+        cpc_cache = data['cpc_cache'] = {}
+        cps_cache = data['cps_cache'] = {}
+        for user_id, p in self._users.items():
+            key = str(user_id)
+            cookies[key] = p.cookies
+            settled_times[key] = p.settled
+            levels = {str(i): level for i, level in enumerate(p.levels) if level}
+            if levels:
+                upgrades[key] = levels
+            if p.cpc is not None:
+                cpc_cache[key] = p.cpc
+            if p.cps is not None:
+                cps_cache[key] = p.cps
+        data['history'] = self._history.to_json()
+        return data
+
+    def _from_json(self, data: dict):
+        """ Replace the in-memory data with data in the layout it's stored in on disk (user
+            and message ids may be given as ints or strings) """
+        cookies = data.pop('cookies', {})
+        settled_times = data.pop('settled_times', {})
+        upgrades = data.pop('upgrades', {})
+        cpc_cache = data.pop('cpc_cache', {})
+        cps_cache = data.pop('cps_cache', {})
+        self._history = History.from_json(data.pop('history', {}))
+
+        # Balances saved before passive income was lazy start accruing from now
+        now = _now()
+        self._users = {}
+        for key in cookies.keys() | upgrades.keys():
+            p = self._users[int(key)] = Participant(cookies.get(key, 0), settled_times.get(key, now))
+            p.cpc = cpc_cache.get(key)
+            p.cps = cps_cache.get(key)
+            for upgrade_id, level in upgrades.get(key, {}).items():
+                p.set_level(int(upgrade_id), level)
+
+        data['upgrade_message_owner_ids'] = {
+            int(message_id): user_id
+            for message_id, user_id in data.get('upgrade_message_owner_ids', {}).items()
+        }
+        data['upgrade_refresh_times'] = {
+            int(user_id): timestamp
+            for user_id, timestamp in data.get('upgrade_refresh_times', {}).items()
+        }
+        data.setdefault('clicker_message_id', None)
+        data.setdefault('clicker_channel_id', None)
+        data.setdefault('last_clicked_time', _1970)
+        data.setdefault('last_clicked_user_id', None)
+        data.setdefault('last_clicked_value', 0)
+        data.setdefault('journal_seq', 0)
+        data.setdefault('catalog_fingerprint', None)
+        self._data = data
+
+    def _write_snapshot(self, data: dict):
+        """ Atomically replace the snapshot file. Write to a temp file of its own, fsync it,
+            then rename it over the old snapshot so a crash can never leave a half written file. """
+        snapshot = json.dumps(data, separators=(',', ':'))
+        fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(self._filepath) or '.',
+                                            prefix=os.path.basename(self._filepath) + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_filepath, self._filepath)
+        except BaseException:
+            os.remove(tmp_filepath)
+            raise
+        metrics.DB_WRITTEN_BYTES.inc(len(snapshot), file='snapshot')
+
+    def _rewrite_journal(self, lines: list[str]):
+        """ Atomically replace the journal with the given lines and reopen it """
+        tmp_filepath = self._journal_filepath + '.tmp'
+        lines = ''.join(lines)
+        with open(tmp_filepath, 'w') as f:
+            f.write(lines)
+            f.flush()
+            os.fsync(f.fileno())
+        metrics.DB_WRITTEN_BYTES.inc(len(lines), file='journal')
+        if self._journal is not None:
+            self._journal.close()
+        os.replace(tmp_filepath, self._journal_filepath)
+        self._journal = open(self._journal_filepath, 'a')
+
+    @metrics.timed(metrics.DB_LOAD_SECONDS)
     def load(self):
-        """ Load the database from the file """
+        """ Load the database from the snapshot file and replay the journal on top of it. The
+            data stays in memory after this, so it only needs to be called once at startup. """
         with open(self._filepath, 'r') as f:
-            self._data = json.loads(f.read() or '{}')
-
-        self._data.setdefault('cookies', {})
-        self._data.setdefault('upgrades', {})
-        self._data.setdefault('cpc_cache', {})
-        self._data.setdefault('cps_cache', {})
-        self._data.setdefault('clicker_message_id', None)
-        self._data.setdefault('clicker_channel_id', None)
-        self._data.setdefault('upgrade_message_owner_ids', {})
-        self._data.setdefault('upgrade_refresh_times', {})
-        self._data.setdefault('last_clicked_time', _1970)
-        self._data.setdefault('last_clicked_user_id', None)
-        self._data.setdefault('last_clicked_value', 0)
+            data = json.loads(f.read() or '{}')
+        self._leaderboard = None
+        self._ownership = None
+        self._from_json(data)
+
+        # Replay mutations that happened after the snapshot was taken. Records with a seq
+        # at or below the snapshot's are leftovers from a compaction that didn't finish.
+        replayed = 0
+        if os.path.exists(self._journal_filepath):
+            self._replaying = True
+            try:
+                with open(self._journal_filepath, 'r') as f:
+                    for line in f:
+                        try:
+                            seq, op, *args = json.loads(line)
+                        except ValueError:
+                            break # torn write at the end of the journal
+                        if seq <= self._data['journal_seq']:
+                            continue
+                        self._replay(op, *args)
+                        self._data['journal_seq'] = seq
+                        replayed += 1
+            finally:
+                self._replaying = False
+
+        self._pending.clear()
+        self._rebuild_indexes()
+        if replayed > 0:
+            # Start from a clean snapshot so new records aren't appended after a torn line
+            self._write_snapshot(self._to_json())
+            self._rewrite_journal([])
+        else:
+            if self._journal is not None:
+                self._journal.close()
+            self._journal = open(self._journal_filepath, 'a')
+
+    async def close(self):
+        """ Compact everything into the snapshot and close the journal """
+        if self._journal is not None:
+            await self.flush(force=True)
+            self._journal.close()
+            self._journal = None
+
+    def _rebuild_indexes(self):
+        """ Build the leaderboard, aggregates and ownership counts from scratch out of the
+            loaded data """
+        now = _now()
+        self._leaderboard = Leaderboard()
+        self._leaderboard.rebuild({
+            user_id: self._line(p)
+            for user_id, p in self._users.items()
+        }, now)
+        self._aggregates = Aggregates()
+        self._aggregates.advance(now)
+        for user_id, p in self._users.items():
+            line = self._line(p)
+            self._aggregates.set(user_id, *line, p.cpc or 0)
+            self._history.record(user_id, now, line[0] + line[1] * now, line[1])
+        self._ownership = Ownership()
+        for p in self._users.values():
+            for upgrade_id, level in enumerate(p.levels):
+                self._ownership.add(upgrade_id, level)
+
+    @staticmethod
+    def _line(p: Participant) -> tuple[int, int]:
+        """ A participant's balance as a line a + c*t over unix time t """
+        cps = p.cps or 0
+        return p.cookies - cps * p.settled, cps
+
+    def _update_indexes(self, user_id: int):
+        """ Update the leaderboard and aggregates after a user's balance, CPC or CPS changed """
+        if self._leaderboard is None:
+            return # still loading
+        now = _now()
+        self._leaderboard.advance(now)
+        self._aggregates.advance(now)
+        p = self._users.get(user_id)
+        if p is not None:
+            line = self._line(p)
+            self._leaderboard.set_line(user_id, *line)
+            self._aggregates.set(user_id, *line, p.cpc or 0)
+            self._history.record(user_id, now, line[0] + line[1] * now, line[1])
+        else:
+            self._leaderboard.remove(user_id)
+            self._aggregates.remove(user_id)
+            self._history.remove(user_id)
+
+    def _participant(self, user_id: int) -> Participant:
+        """ Record of a given user, which is added if they don't have one yet """
+        p = self._users.get(user_id)
+        if p is None:
+            p = self._users[user_id] = Participant(settled=_now())
+        return p
 
     def get_json(self, indent=4):
         """ get a copy of all the data in the database as a json string """
-        return json.dumps(self._data, indent=indent)
+        return json.dumps(self._to_json(), indent=indent)
 
     # --- Message storage --- #
     def get_clicker_message_id(self) -> int | None:
@@ -67,22 +518,26 @@ class Database:
 
     def set_clicker_message_id(self, message_id: int | None):
         """ Set the clicker message id """
+        self._record('set_clicker_message_id', message_id)
         self._data['clicker_message_id'] = message_id
 
     def set_clicker_channel_id(self, channel_id: int | None):
         """ Set the clicker channel id """
+        self._record('set_clicker_channel_id', channel_id)
         self._data['clicker_channel_id'] = channel_id
 
     def get_upgrade_message_owner_id(self, message_id: int) -> int | None:
         """ ID of the user who owns the given upgrade message """
-        return self._data['upgrade_message_owner_ids'].get(str(message_id), None)
+        return self._data['upgrade_message_owner_ids'].get(message_id, None)
 
     def set_upgrade_message_owner_id(self, message_id: int | None, user_id: int):
         """ Set the owner of the given upgrade message """
-        self._data['upgrade_message_owner_ids'][str(message_id)] = user_id
+        self._record('set_upgrade_message_owner_id', message_id, user_id)
+        self._data['upgrade_message_owner_ids'][message_id] = user_id
 
     def clear_upgrade_message_owner_ids(self):
         """ Deletes all upgrade message owner ids """
+        self._record('clear_upgrade_message_owner_ids')
         self._data['upgrade_message_owner_ids'].clear()
 
     def get_upgrade_refresh_cooldown_remaining(self, cooldown: int, user_id: int) -> float:
@@ -92,58 +547,179 @@ class Database:
 
     def get_upgrade_refresh_time(self, user_id: int) -> datetime:
         """ Timestamp of when the upgrade refresh was last clicked by the given user """
-        return datetime.fromisoformat(self._data['upgrade_refresh_times'].get(str(user_id), _1970))
+        return datetime.fromisoformat(self._data['upgrade_refresh_times'].get(user_id, _1970))
 
     def set_upgrade_refresh_time(self, user_id: int, timestamp: datetime = None) -> datetime:
         """ Set the timestamp of when the upgrade refresh button was last clicked by the given user """
         if timestamp is None:
             timestamp = datetime.utcnow()
-        self._data['upgrade_refresh_times'][str(user_id)] = timestamp.isoformat()
+        self._record('set_upgrade_refresh_time', user_id, timestamp.isoformat())
+        self._data['upgrade_refresh_times'][user_id] = timestamp.isoformat()
         return timestamp
 
     # --- Cookie counts --- #
+    # Passive income isn't added every second. Each user has a base amount and the time it was
+    # settled at, and their balance is base + CPS * seconds since then. A balance only needs to
+    # be settled again when the user's CPS changes.
 
     def get_total_cookies(self) -> int:
         """ Total number of cookies everyone collectively has (excludes negative
             cookie counts) """
-        return sum(
-            max(0, self.get_cookies(user_id))
-            for user_id in self.get_participants_user_ids()
-        )
+        self._aggregates.advance(_now())
+        return self._aggregates.total()
+
+    def get_total_cookies_per_second(self) -> int:
+        """ Combined CPS of everyone """
+        return self._aggregates.total_cps
+
+    def get_total_cookies_per_click(self) -> int:
+        """ Combined CPC of everyone (not including the base number of cookies the button gives) """
+        return self._aggregates.total_cpc
+
+    def get_participant_count(self) -> int:
+        """ Number of people who have clicked the button before """
+        return len(self._aggregates)
+
+    def get_cookie_percentiles(self, percentiles: list[float]) -> list[int]:
+        """ Cookie counts at the given percentiles (0 to 100) of everyone's cookie counts """
+        self._leaderboard.advance(_now())
+        n = len(self._leaderboard)
+        if n == 0:
+            return [0] * len(percentiles)
+        return [
+            self.get_cookies(self._leaderboard.nth(round((100 - p) / 100 * (n - 1))))
+            for p in percentiles
+        ]
+
+    def get_cookie_histogram(self, base: int = 1000, max_exp: int = 34) -> list[tuple[int, int]]:
+        """ Log scale histogram of everyone's cookie counts, as (lower bound, count) for each
+            bucket. The first bucket is everyone with 0 or less, then [1, base), [base, base^2)
+            and so on up to base^max_exp. """
+        self._leaderboard.advance(_now())
+        bounds = [base ** e for e in range(max_exp + 1)]
+        at_least = [self._leaderboard.count_at_least(bound) for bound in bounds] + [0]
+        histogram = [(0, len(self._leaderboard) - at_least[0])]
+        for i, bound in enumerate(bounds):
+            histogram.append((bound, at_least[i] - at_least[i + 1]))
+        return histogram
+
+    def get_balance_growth(self, user_id: int, seconds: int) -> tuple[int, int] | None:
+        """ (cookies, seconds) a given user's balance actually grew by over about the last given
+            number of seconds, including clicks, purchases and swindles. The span is shorter if
+            their history doesn't go back that far. None if there's no history for them. """
+        return self._history.growth(user_id, _now(), seconds)
 
     def get_cookies(self, user_id: int) -> int:
         """ Number of cookies a given user has """
-        return self._data['cookies'].get(str(user_id), 0)
+        p = self._users.get(user_id)
+        if p is None:
+            return 0
+        if not p.cps:
+            return p.cookies
+        return p.cookies + p.cps * (_now() - p.settled)
 
     def set_cookies(self, user_id: int, cookies: int):
         """ Sets the cookie count for a given user """
-        self._data['cookies'][str(user_id)] = cookies
+        self._settle(user_id, cookies)
 
     def add_cookies(self, user_id: int, cookies: int):
         """ Adds cookies to a given user's count """
-        self.set_cookies(user_id, self.get_cookies(user_id) + cookies)
-
-    def get_ranks(self, upgrades: list[Upgrade]) -> list[tuple[int, int, int]]:
-        """ Sorted list of (cookie count, CPS, user id) with highest cookies first """
-        ranks = []
-        for user_id in self.get_participants_user_ids():
+        p = self._users.get(user_id)
+        if p is None:
+            self._settle(user_id, cookies)
+            return
+        self._record('add_cookies', user_id, cookies)
+        p.cookies += cookies
+        self._update_indexes(user_id)
+
+    def _settle(self, user_id: int, cookies: int | None = None, timestamp: int | None = None):
+        """ Fold the passive income a user has earned so far into their base amount (or replace
+            it with the given amount) and start accruing again from now """
+        if timestamp is None:
+            timestamp = _now()
+        if cookies is None:
             cookies = self.get_cookies(user_id)
+        self._record('settle', user_id, cookies, timestamp)
+        p = self._participant(user_id)
+        p.cookies = cookies
+        p.settled = timestamp
+        self._update_indexes(user_id)
+
+    def _settle_all(self, timestamp: int):
+        """ Settle everyone's passive income at the given time in one pass. The indexes are left
+            alone, so they have to be rebuilt after. """
+        for user_id, p in self._users.items():
+            cookies = p.cookies + (p.cps or 0) * (timestamp - p.settled)
+            self._record('settle', user_id, cookies, timestamp)
+            p.cookies = cookies
+            p.settled = timestamp
+
+    def get_ranks(self, upgrades: list[Upgrade], limit: int | None = None) -> list[tuple[int, int, int]]:
+        """ Sorted list of (cookie count, CPS, user id) with highest cookies first. If limit is
+            given, only the top that many are returned. """
+        self._leaderboard.advance(_now())
+        ranks = []
+        for user_id in self._leaderboard.top(limit):
             cps = self.get_cookies_per_second(upgrades, user_id)
-            ranks.append((cookies, cps, user_id))
-        ranks.sort(reverse=True)
+            ranks.append((self.get_cookies(user_id), cps, user_id))
         return ranks
 
-    def clear_cpc_cps_caches(self):
-        """ Clear cached CPC and CPS values (only necessary if upgrade config is changed) """
-        self._data['cpc_cache'].clear()
-        self._data['cps_cache'].clear()
+    def get_rank(self, user_id: int) -> int | None:
+        """ 0-based leaderboard position of a given user (None if they aren't on it) """
+        self._leaderboard.advance(_now())
+        return self._leaderboard.rank(user_id)
+
+    def get_next_overtake(self, user_id: int) -> tuple[int, float | None] | None:
+        """ (user id, seconds) of the player right above the given user, and how long until the
+            given user passes them at their current CPS (None if never). None if they're first. """
+        now = _now()
+        self._leaderboard.advance(now)
+        above = self._leaderboard.next_above(user_id)
+        if above is None:
+            return None
+        other_user_id, t = above
+        return other_user_id, None if t is None else t - now
+
+    def get_next_overtaken(self, user_id: int) -> tuple[int, float | None] | None:
+        """ (user id, seconds) of the player right below the given user, and how long until they
+            pass the given user at their current CPS (None if never). None if they're last. """
+        now = _now()
+        self._leaderboard.advance(now)
+        below = self._leaderboard.next_below(user_id)
+        if below is None:
+            return None
+        other_user_id, t = below
+        return other_user_id, None if t is None else t - now
+
+    def recompute_stats(self, upgrades: list[Upgrade]):
+        """ Compute everyone's derived stats again from the given upgrades in one pass, for when
+            the upgrade config changed. Everyone's passive income is settled first, so it accrues
+            at the new rate from now. """
+        self._settle_all(_now())
+        for user_id, p in self._users.items():
+            p.cpc = p.cps = p.swindle = p.invested = None
+            self._compute_stats(upgrades, p)
+            self._record('set_stats', user_id, p.cpc, p.cps)
+        if self._leaderboard is not None:
+            self._rebuild_indexes()
+
+    def get_catalog_fingerprint(self) -> str | None:
+        """ Fingerprint of the upgrade config the cached stats were computed with """
+        return self._data['catalog_fingerprint']
+
+    def set_catalog_fingerprint(self, fingerprint: str):
+        """ Set the fingerprint of the upgrade config the cached stats were computed with """
+        self._record('set_catalog_fingerprint', fingerprint)
+        self._data['catalog_fingerprint'] = fingerprint
 
     def delete_participant(self, user_id: int):
         """ Delete all data associated with a single participant """
-        self._data['cookies'].pop(str(user_id), None)
-        self._data['upgrades'].pop(str(user_id), None)
-        self._data['cpc_cache'].pop(str(user_id), None)
-        self._data['cps_cache'].pop(str(user_id), None)
+        self._record('delete_participant', user_id)
+        p = self._users.pop(user_id, None)
+        if p is not None and self._ownership is not None:
+            for upgrade_id, level in enumerate(p.levels):
+                self._ownership.remove(upgrade_id, level)
+        self._update_indexes(user_id)
         if user_id == self._data['last_clicked_user_id']:
             self._data['last_clicked_user_id'] = None
             self._data['last_clicked_value'] = 0
@@ -153,81 +729,119 @@ class Database:
     def get_upgrade_levels(self, upgrades: list[Upgrade], user_id: int) -> list[int]:
         """ Returns a list of levels for the upgrades the given user owns (indices
             match given upgrades list) """
-        levels = [0] * len(upgrades)
-        for id, level in self._data['upgrades'].get(str(user_id), {}).items():
-            levels[int(id)] = level
+        p = self._users.get(user_id)
+        levels = p.levels[:len(upgrades)].tolist() if p is not None else []
+        levels.extend([0] * (len(upgrades) - len(levels)))
         return levels
 
     def get_upgrade_level(self, user_id: int, upgrade_id: int) -> int:
         """ Level of a specific upgrade """
-        return self._data['upgrades'].get(str(user_id), {}).get(str(upgrade_id), 0)
+        p = self._users.get(user_id)
+        return p.get_level(upgrade_id) if p is not None else 0
+
+    def _derive(self, upgrades: list[Upgrade], user_id: int) -> Participant | None:
+        """ A user's record with all of the stats derived from their upgrade levels filled in.
+            Anything missing is computed in a single pass over the levels, but cached CPC and
+            CPS are kept, since passive income so far was settled at those. """
+        p = self._users.get(user_id)
+        if p is None:
+            return None
+        if p.cpc is None or p.cps is None or p.swindle is None or p.invested is None:
+            if self._compute_stats(upgrades, p):
+                self._update_indexes(user_id)
+        return p
+
+    @staticmethod
+    def _compute_stats(upgrades: list[Upgrade], p: Participant) -> bool:
+        """ Fill in a participant's missing derived stats. Returns True if CPC or CPS changed. """
+        cpc = cps = invested = 0
+        miss = 1.0
+        for u, level in zip(upgrades, p.levels):
+            if level > 0:
+                cpc += u.get_cookies_per_click(level)
+                cps += u.get_cookies_per_second(level)
+                miss *= 1 - u.get_swindle_probability(level)
+                invested += u.get_spent(level)
+        changed = p.cpc is None or p.cps is None
+        if p.cpc is None:
+            p.cpc = cpc
+        if p.cps is None:
+            p.cps = cps
+        if p.swindle is None:
+            p.swindle = 1 - miss
+        if p.invested is None:
+            p.invested = invested
+        return changed
 
     def get_cookies_per_second(self, upgrades: list[Upgrade], user_id: int) -> int:
         """ Number of cookies a given user gets each second through passive upgrades """
-        if str(user_id) in self._data['cps_cache']:
-            return self._data['cps_cache'][str(user_id)]
-        cps = sum(
-            upgrades[i].get_cookies_per_second(level)
-            for i, level in enumerate(self.get_upgrade_levels(upgrades, user_id))
-        )
-        self._data['cps_cache'][str(user_id)] = cps
-        return cps
+        p = self._derive(upgrades, user_id)
+        return p.cps if p is not None else 0
 
     def get_cookies_per_click(self, upgrades: list[Upgrade], user_id: int) -> int:
         """ Number of cookies a given user gets from clicking due to upgrades.
             Does not include the base number of cookies the button gives. """
-        if str(user_id) in self._data['cpc_cache']:
-            return self._data['cpc_cache'][str(user_id)]
-        cpc = sum(
-            upgrades[i].get_cookies_per_click(level)
-            for i, level in enumerate(self.get_upgrade_levels(upgrades, user_id))
-        )
-        self._data['cpc_cache'][str(user_id)] = cpc
-        return cpc
+        p = self._derive(upgrades, user_id)
+        return p.cpc if p is not None else 0
 
     def get_swindle_probability(self, upgrades: list[Upgrade],  user_id: int) -> float:
         """ Probability of swindling cookies for the given user """
-        return 1 - math.prod(
-            1 - upgrades[i].get_swindle_probability(level)
-            for i, level in enumerate(self.get_upgrade_levels(upgrades, user_id))
-        )
+        p = self._derive(upgrades, user_id)
+        return p.swindle if p is not None else 0.0
 
     def get_spent_on_upgrades(self, upgrades: list[Upgrade], user_id: int) -> int:
-        """ How many cookies a given user has spent on upgrades """
-        return sum(
-            upgrades[i].get_price(level)
-            for i, level in enumerate(self.get_upgrade_levels(upgrades, user_id))
-        )
+        """ How many cookies a given user has spent on upgrades, over every level bought """
+        p = self._derive(upgrades, user_id)
+        return p.invested if p is not None else 0
 
     def set_upgrade_level(self, upgrades: list[Upgrade], user_id: int, upgrade_id: int, level: int):
         """ Sets the level of an upgrade for a given user """
-        if str(user_id) not in self._data['upgrades']:
-            self._data['upgrades'][str(user_id)] = {}
-
-        old_level = self._data['upgrades'][str(user_id)].get(str(upgrade_id), 0)
-        self._data['upgrades'][str(user_id)][str(upgrade_id)] = level
-
-        # Update caches
+        p = self._derive(upgrades, user_id)
+        if p is None:
+            old_cpc, old_cps, old_swindle, old_invested, old_level = 0, 0, 0.0, 0, 0
+        else:
+            old_cpc, old_cps, old_swindle, old_invested = p.cpc, p.cps, p.swindle, p.invested
+            old_level = p.get_level(upgrade_id)
+
+        # Only this upgrade's part of each stat changes
         u = upgrades[upgrade_id]
-        cpc_diff = u.get_cookies_per_click(level) - u.get_cookies_per_click(old_level)
-        cps_diff = u.get_cookies_per_second(level) - u.get_cookies_per_second(old_level)
-        if cpc_diff != 0:
-            self._data['cpc_cache'][str(user_id)] = self._data['cpc_cache'].get(str(user_id), 0) + cpc_diff
-        if cps_diff != 0:
-            self._data['cps_cache'][str(user_id)] = self._data['cps_cache'].get(str(user_id), 0) + cps_diff
+        cpc = old_cpc + u.get_cookies_per_click(level) - u.get_cookies_per_click(old_level)
+        cps = old_cps + u.get_cookies_per_second(level) - u.get_cookies_per_second(old_level)
+        invested = old_invested + u.get_spent(level) - u.get_spent(old_level)
+        old_miss = 1 - u.get_swindle_probability(old_level)
+        if old_miss > 0:
+            swindle = 1 - (1 - old_swindle) / old_miss * (1 - u.get_swindle_probability(level))
+        else:
+            swindle = None # can't divide out a certain swindle, so compute it again when needed
+
+        # Passive income so far was earned at the old CPS
+        if cps != old_cps or p is None:
+            self._settle(user_id)
+
+        self._record('set_upgrade_level', user_id, upgrade_id, level, cpc, cps)
+        p = self._users[user_id]
+        p.set_level(upgrade_id, level)
+        p.cpc = cpc
+        p.cps = cps
+        p.swindle = swindle
+        p.invested = invested
+        self._update_indexes(user_id)
+        if self._ownership is not None:
+            self._ownership.change(upgrade_id, old_level, level)
 
     def does_someone_own(self, upgrade_id: int, level: int):
         """ True if anyone owns the given upgrade at the given level or higher """
-        for purchases in self._data['upgrades'].values():
-            if purchases.get(str(upgrade_id), 0) >= level:
-                return True
-        return False
+        return level <= self._ownership.max_level(upgrade_id)
+
+    def get_owner_count(self, upgrade_id: int) -> int:
+        """ Number of people who own the given upgrade at any level """
+        return self._ownership.owner_count(upgrade_id)
 
     # --- Clicker state --- #
 
     def get_participants_user_ids(self) -> list[int]:
         """ Set of user_ids of people who have clicked the button before """
-        return list(map(int, self._data['cookies'].keys()))
+        return list(self._users)
 
     def get_last_clicked_time(self) -> datetime:
         """ Timestamp of when the button was last clicked by someone """
@@ -237,6 +851,7 @@ class Database:
         """ Set the timestamp of when the button was last clicked """
         if timestamp is None:
             timestamp = datetime.utcnow()
+        self._record('set_last_clicked_time', timestamp.isoformat())
         self._data['last_clicked_time'] = timestamp.isoformat()
         return timestamp
 
@@ -246,6 +861,7 @@ class Database:
 
     def set_last_clicked_user_id(self, user_id: int | None):
         """ Set the user id of the person who last clicked the button """
+        self._record('set_last_clicked_user_id', user_id)
         self._data['last_clicked_user_id'] = user_id
 
     def get_last_clicked_value(self) -> int:
@@ -254,6 +870,7 @@ class Database:
 
     def set_last_clicked_value(self, cookies: int):
         """ Set how many cookies the last button click gave """
+        self._record('set_last_clicked_value', cookies)
         self._data['last_clicked_value'] = cookies
 
     def get_cooldown_remaining(self, cooldown: int) -> float:
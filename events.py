@@ -0,0 +1,119 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+import metrics
+from util import uncancellable
+
+log = logging.getLogger('bot')
+
+
+class EventLog:
+    """ Append-only log of game events (clicks, swindles, purchases, dev changes), one compact
+        json record per line. Emitting an event only adds it to a buffer. A background task
+        writes the buffer in batches from a worker thread, so handlers never touch the disk.
+
+        Each record is {"seq": n, "t": unix time, "type": type, ...fields}. Events are emitted
+        inside the transaction that made the change, so seq follows the order changes were
+        made in. The file is rotated to file.1, file.2, ... once it grows past max_size. """
+
+    def __init__(self, filepath: str, flush_interval: float, fsync: bool = False,
+                 max_size: int | None = None, backups: int = 5):
+        self._filepath = filepath
+        self._flush_interval = flush_interval
+        self._fsync = fsync
+        self._max_size = max_size
+        self._backups = backups
+        self._buffer: list[str] = []
+        self._seq = self._last_seq()
+        self._task: asyncio.Task | None = None
+        self._write_lock = asyncio.Lock()
+
+    def emit(self, type: str, **fields):
+        """ Record an event. It's written to the file with the next batch. """
+        self._seq += 1
+        record = {'seq': self._seq, 't': round(time.time(), 3), 'type': type, **fields}
+        self._buffer.append(json.dumps(record, separators=(',', ':')) + '\n')
+
+    def start(self):
+        """ Start writing batches in the background """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """ Stop the background writer and write whatever is left """
+        if self._task is not None:
+            task, self._task = self._task, None
+            task.cancel()
+            await asyncio.wait([task])
+        await self.flush()
+
+    async def flush(self):
+        """ Write every buffered event """
+        async with self._write_lock:
+            if not self._buffer:
+                return
+            batch, self._buffer = ''.join(self._buffer), []
+            try:
+                # Runs to the end even if this is cancelled, so the lock is held until the worker
+                # thread is done and a batch is never written twice
+                await uncancellable(asyncio.to_thread(self._write, batch))
+            except Exception:
+                self._buffer.insert(0, batch) # try again with the next batch
+                raise
+
+    async def _run(self):
+        log.debug(f'Event log writer started. ({self._flush_interval}s)')
+        try:
+            while True:
+                await asyncio.sleep(self._flush_interval)
+                try:
+                    await self.flush()
+                except Exception:
+                    log.exception('Failed to write events')
+        finally:
+            log.debug('Event log writer stopped.')
+
+    def _write(self, batch: str):
+        with open(self._filepath, 'a') as f:
+            f.write(batch)
+            f.flush()
+            if self._fsync:
+                os.fsync(f.fileno())
+            size = f.tell()
+        metrics.DB_WRITTEN_BYTES.inc(len(batch), file='events')
+        if self._max_size is not None and size >= self._max_size:
+            # The batch is written by now, so a failed rotation mustn't get it written again.
+            # It's tried again after the next batch.
+            try:
+                self._rotate()
+            except OSError:
+                log.exception('Failed to rotate the event log')
+
+    def _rotate(self):
+        """ Shift file.1 to file.2 and so on (dropping the oldest), then move the file to file.1 """
+        for i in range(self._backups - 1, 0, -1):
+            src = f'{self._filepath}.{i}'
+            if os.path.exists(src):
+                os.replace(src, f'{self._filepath}.{i + 1}')
+        if self._backups > 0:
+            os.replace(self._filepath, f'{self._filepath}.1')
+        else:
+            os.remove(self._filepath)
+
+    def _last_seq(self) -> int:
+        """ Seq of the last event already in the file (or its latest backup), so numbering
+            continues across restarts """
+        for filepath in (self._filepath, f'{self._filepath}.1'):
+            if not os.path.exists(filepath):
+                continue
+            with open(filepath, 'rb') as f:
+                f.seek(max(0, os.path.getsize(filepath) - 4096))
+                for line in reversed(f.read().splitlines()):
+                    try:
+                        return json.loads(line)['seq']
+                    except (ValueError, KeyError, TypeError):
+                        continue # torn write or the start of a cut off line
+        return 0
@@ -0,0 +1,123 @@
+from bisect import bisect_left
+
+# (bucket length in seconds, number of buckets) for each resolution. One more bucket than
+# needed, so a full hour, day and week back is always covered.
+_RESOLUTIONS = ((60, 61), (60 * 60, 25), (60 * 60 * 24, 8))
+# Tracks are pruned once they have this many knots. Pruning leaves at most one per bucket.
+_MAX_KNOTS = 2 * sum(slots for _, slots in _RESOLUTIONS)
+
+
+class _Track:
+    """ Balance history of a single participant, as the exact balance and CPS right after each
+        change (a knot). Between changes a balance grows linearly, so the balance at the start
+        of any bucket follows exactly from the last knot before it. Only the knots needed for
+        the starts of the last 61 minutes, 25 hours and 8 days are kept, so a participant who
+        doesn't do anything has a single knot, and nobody has more than _MAX_KNOTS. """
+    __slots__ = ('start', 'first', 'knots')
+
+    def __init__(self, start: int, first: int, knots: list[tuple[int, int, int]]):
+        self.start = start # when tracking started
+        self.first = first # balance at the start
+        self.knots = knots # (time, balance, cps), oldest first
+
+    def record(self, t: int, balance: int, cps: int):
+        last = self.knots[-1][0]
+        t = max(t, last)
+        # No bucket starts after the last knot and at or before t if they're in the same
+        # minute, so the last knot isn't needed anymore
+        if t // 60 == last // 60:
+            self.knots[-1] = (t, balance, cps)
+        else:
+            self.knots.append((t, balance, cps))
+            if len(self.knots) > _MAX_KNOTS:
+                self._prune()
+
+    def _prune(self):
+        """ Drop knots that no bucket start still in range comes right after. A knot is needed
+            for a bucket start b if it's the last one before b, which means b is after it and
+            at or before the next knot. """
+        knots = self.knots
+        now = knots[-1][0]
+        kept = []
+        for knot, after in zip(knots, knots[1:]):
+            t, t_after = knot[0], after[0]
+            if any(t // length < t_after // length > now // length - slots
+                   for length, slots in _RESOLUTIONS):
+                kept.append(knot)
+        kept.append(knots[-1])
+        self.knots = kept
+
+    def value_at(self, t: int) -> tuple[int, int] | None:
+        """ (balance, time) at the start of the first bucket at or after t, in the finest
+            resolution that still goes back that far, or exactly at t if that's after the last
+            change. None if it's too far back. """
+        last_time, balance, cps = self.knots[-1]
+        if t >= last_time:
+            return balance + cps * (t - last_time), t
+        if t <= self.start:
+            return self.first, self.start
+        for length, slots in _RESOLUTIONS:
+            b = -(-t // length) * length
+            if b // length > last_time // length - slots:
+                # Balance just before b, from the last knot before it
+                i = bisect_left(self.knots, (b,)) - 1
+                if i < 0:
+                    return self.first, self.start
+                knot_time, balance, cps = self.knots[i]
+                return balance + cps * (b - knot_time), b
+        return None
+
+    def to_json(self) -> list:
+        return [self.start, self.first, list(self.knots)]
+
+    @classmethod
+    def from_json(cls, data: list) -> '_Track':
+        start, first, knots = data
+        return cls(start, first, [tuple(knot) for knot in knots])
+
+
+class History:
+    """ Recent balance history of every participant, fed from balance changes. Balances are
+        kept exactly, and memory per participant is bounded no matter how long the game runs.
+        It's saved with the database snapshot. """
+
+    def __init__(self, tracks: dict[int, _Track] | None = None):
+        self._tracks: dict[int, _Track] = tracks or {}
+
+    def __len__(self):
+        return len(self._tracks)
+
+    def record(self, user_id: int, t: int, balance: int, cps: int):
+        """ Record a participant's balance and CPS right after a change at time t """
+        track = self._tracks.get(user_id)
+        if track is None:
+            self._tracks[user_id] = _Track(t, balance, [(t, balance, cps)])
+        else:
+            track.record(t, balance, cps)
+
+    def remove(self, user_id: int):
+        self._tracks.pop(user_id, None)
+
+    def growth(self, user_id: int, t: int, seconds: int) -> tuple[int, int] | None:
+        """ (cookies, seconds) a participant's balance grew by from about the given number of
+            seconds before t, to t. The span is shorter if their history doesn't go back that
+            far. None if there's no history. """
+        track = self._tracks.get(user_id)
+        if track is None:
+            return None
+        since = max(t - seconds, track.start)
+        then = track.value_at(since)
+        if then is None:
+            return None
+        value, _ = then
+        last_time, balance, cps = track.knots[-1]
+        return balance + cps * (t - last_time) - value, t - since
+
+    def to_json(self) -> dict:
+        """ Every track in a json layout. This is a new copy, so it can be serialized from
+            another thread. """
+        return {str(user_id): track.to_json() for user_id, track in self._tracks.items()}
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'History':
+        return cls({int(user_id): _Track.from_json(track) for user_id, track in data.items()})
@@ -0,0 +1,209 @@
+import heapq
+
+
+class Leaderboard:
+    """ Keeps participants sorted by balance without re-sorting everyone on every read.
+
+        Between purchases a balance grows linearly (base + CPS * time), so each participant is
+        a line a + c*t and the moment one passes another can be computed exactly. Only
+        neighbours can pass each other, so a heap holds the next crossing time of every
+        adjacent pair, and advancing the clock just swaps the pairs whose time has come.
+        Changing someone's line only moves that one participant and reschedules their
+        neighbours.
+
+        Ties are broken like sorting (cookies, cps, user id) tuples: higher CPS first, then
+        higher user id. """
+
+    def __init__(self):
+        self._lines: dict[int, tuple[int, int]] = {}
+        self._versions: dict[int, int] = {}
+        self._order: list[int] = [] # lowest first
+        self._pos: dict[int, int] = {}
+        self._events: list[tuple[int, int, int, int, int]] = []
+        self._time = 0
+        self._next_version = 0
+
+    def __len__(self):
+        return len(self._order)
+
+    def __contains__(self, user_id: int):
+        return user_id in self._lines
+
+    def _key(self, user_id: int, t: int) -> tuple[int, int, int]:
+        a, c = self._lines[user_id]
+        return a + c * t, c, user_id
+
+    def value(self, user_id: int, t: int) -> int:
+        """ Balance of a participant at time t """
+        a, c = self._lines[user_id]
+        return a + c * t
+
+    def _crossing_time(self, lower: int, upper: int) -> int | None:
+        """ First time the lower participant ranks above the upper one, or None if never """
+        a_lo, c_lo = self._lines[lower]
+        a_hi, c_hi = self._lines[upper]
+        if c_lo <= c_hi:
+            return None
+        return -((a_lo - a_hi) // (c_lo - c_hi)) # ceil((a_hi - a_lo) / (c_lo - c_hi))
+
+    def _schedule(self, i: int):
+        """ Schedule the crossing of the pair at positions i and i+1 (if there is one) """
+        if i < 0 or i + 1 >= len(self._order):
+            return
+        lower, upper = self._order[i], self._order[i + 1]
+        t = self._crossing_time(lower, upper)
+        if t is not None:
+            heapq.heappush(self._events, (
+                max(t, self._time), lower, upper, self._versions[lower], self._versions[upper]
+            ))
+
+    def _reindex(self, start: int, stop: int):
+        for i in range(start, min(stop, len(self._order))):
+            self._pos[self._order[i]] = i
+
+    def rebuild(self, lines: dict[int, tuple[int, int]], t: int):
+        """ Replace everything with the given {user id: (a, c)} lines, sorted at time t """
+        self._lines = dict(lines)
+        self._versions = dict.fromkeys(lines, self._next_version)
+        self._next_version += 1
+        self._resort(t)
+
+    def _resort(self, t: int):
+        """ Sort everyone from scratch at time t and schedule all adjacent pairs again """
+        self._time = t
+        self._order = sorted(self._lines, key=lambda user_id: self._key(user_id, t))
+        self._pos = {}
+        self._reindex(0, len(self._order))
+        self._reschedule()
+
+    def _reschedule(self):
+        """ Drop every event and schedule all adjacent pairs again """
+        self._events = []
+        for i in range(len(self._order) - 1):
+            self._schedule(i)
+
+    def set_line(self, user_id: int, a: int, c: int):
+        """ Add a participant, or move one whose balance or CPS changed. The leaderboard must
+            already be advanced to the current time. """
+        if self._lines.get(user_id) == (a, c):
+            return
+        old = self._pos.pop(user_id, None)
+        if old is not None:
+            self._order.pop(old)
+        self._lines[user_id] = (a, c)
+        # Versions are never reused, so events from before a line changed (or from before
+        # the participant was removed and added back) can be told apart
+        self._versions[user_id] = self._next_version
+        self._next_version += 1
+
+        # Everyone else is sorted at the current time, so binary search for the new spot
+        key = self._key(user_id, self._time)
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._key(self._order[mid], self._time) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        self._order.insert(lo, user_id)
+
+        if old is None:
+            self._reindex(lo, len(self._order))
+        else:
+            self._reindex(min(old, lo), max(old, lo) + 1)
+            if old < len(self._order) and old != lo:
+                # Whoever closed the gap left behind has new neighbours
+                self._schedule(old - 1)
+                self._schedule(old)
+        self._schedule(lo - 1)
+        self._schedule(lo)
+        self._prune()
+
+    def _prune(self):
+        """ Outdated events far in the future would otherwise pile up forever """
+        if len(self._events) > 4 * len(self._order) + 64:
+            self._reschedule()
+
+    def remove(self, user_id: int):
+        """ Remove a participant """
+        i = self._pos.pop(user_id, None)
+        if i is None:
+            return
+        self._order.pop(i)
+        del self._lines[user_id]
+        del self._versions[user_id]
+        self._reindex(i, len(self._order))
+        self._schedule(i - 1)
+
+    def advance(self, t: int):
+        """ Move the clock forward to time t, applying every overtake that happens by then. If
+            there are too many of them (after a long quiet spell, or when many similar lines
+            are tangled together), everyone is sorted from scratch instead. """
+        # An overtake costs several times what a participant adds to a sort, so give up once
+        # the overtakes have cost about as much as sorting would
+        n = len(self._order)
+        budget = n // 4 + 64
+        while self._events and self._events[0][0] <= t:
+            budget -= 1
+            if budget < 0:
+                self._resort(t)
+                return
+            when, lower, upper, v_lo, v_hi = heapq.heappop(self._events)
+            if self._versions.get(lower) != v_lo or self._versions.get(upper) != v_hi:
+                continue # someone's line changed since this was scheduled
+            i = self._pos[lower]
+            if i + 1 >= len(self._order) or self._order[i + 1] != upper:
+                continue # not neighbours anymore
+            self._time = when
+            self._order[i], self._order[i + 1] = upper, lower
+            self._pos[upper], self._pos[lower] = i, i + 1
+            self._schedule(i - 1)
+            self._schedule(i + 1)
+        self._time = max(self._time, t)
+        self._prune()
+
+    def top(self, n: int | None = None) -> list[int]:
+        """ User ids from highest balance to lowest, optionally only the first n """
+        if n is None:
+            return self._order[::-1]
+        return self._order[:-n - 1:-1] if n > 0 else []
+
+    def nth(self, rank: int) -> int:
+        """ User id of the participant at the given 0-based position from the top """
+        return self._order[len(self._order) - 1 - rank]
+
+    def count_at_least(self, value: int) -> int:
+        """ Number of participants with a balance of at least the given value """
+        lo, hi = 0, len(self._order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.value(self._order[mid], self._time) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return len(self._order) - lo
+
+    def rank(self, user_id: int) -> int | None:
+        """ 0-based position of a participant from the top, or None if not on the leaderboard """
+        i = self._pos.get(user_id)
+        if i is None:
+            return None
+        return len(self._order) - 1 - i
+
+    def next_above(self, user_id: int) -> tuple[int, int | None] | None:
+        """ (user id, time) of the participant directly above the given one and when the given
+            one passes them at the current rates (time is None if never). None if first. """
+        i = self._pos[user_id]
+        if i + 1 >= len(self._order):
+            return None
+        upper = self._order[i + 1]
+        return upper, self._crossing_time(user_id, upper)
+
+    def next_below(self, user_id: int) -> tuple[int, int | None] | None:
+        """ (user id, time) of the participant directly below the given one and when they pass
+            the given one at the current rates (time is None if never). None if last. """
+        i = self._pos[user_id]
+        if i == 0:
+            return None
+        lower = self._order[i - 1]
+        return lower, self._crossing_time(lower, user_id)
@@ -0,0 +1,199 @@
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from typing import Callable
+
+from aiohttp import web
+
+log = logging.getLogger('bot')
+
+_DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+def _labels_str(names: tuple[str, ...], values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric:
+    """ A named metric with a value (or several) per combination of label values, shown in
+        Prometheus' text format """
+    type = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _registry.append(self)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(labels[name] for name in self.labels)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self) -> list[str]:
+        return [
+            f'{self.name}{_labels_str(self.labels, key)} {value}'
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(Metric):
+    """ Gauge without labels whose value is read from a function when metrics are collected """
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help)
+        self._function: Callable[[], float] | None = None
+
+    def set_function(self, function: Callable[[], float]):
+        self._function = function
+
+    def _samples(self) -> list[str]:
+        if self._function is None:
+            return []
+        try:
+            return [f'{self.name} {self._function()}']
+        except Exception:
+            log.exception(f'Failed to collect {self.name}')
+            return []
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = _DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._values: dict[tuple, list] = {} # label values -> [bucket counts, sum, count]
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        i = bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            entry[0][i] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def _samples(self) -> list[str]:
+        samples = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            labels = _labels_str(self.labels, key)
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{bound}"'
+                samples.append(f'{self.name}_bucket{_labels_str(self.labels, key, le)} {cumulative}')
+            le = 'le="+Inf"'
+            samples.append(f'{self.name}_bucket{_labels_str(self.labels, key, le)} {count}')
+            samples.append(f'{self.name}_sum{labels} {total}')
+            samples.append(f'{self.name}_count{labels} {count}')
+        return samples
+
+
+def timed(histogram: Histogram, **labels):
+    """ Decorator that observes how long each call of a function (sync or async) takes """
+    def decorator(f):
+        if asyncio.iscoroutinefunction(f):
+            @functools.wraps(f)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await f(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+        else:
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    histogram.observe(time.perf_counter() - start, **labels)
+        return wrapper
+    return decorator
+
+
+_registry: list[Metric] = []
+
+def render() -> str:
+    """ Every metric in Prometheus' text format """
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+HANDLER_SECONDS = Histogram(
+    'cookiebot_handler_seconds', 'Time taken to handle a button, select or command',
+    ('handler', 'outcome')
+)
+DB_LOCK_WAIT_SECONDS = Histogram(
+    'cookiebot_db_lock_wait_seconds', 'Time transactions waited for the database lock',
+    ('transaction',)
+)
+DB_LOCK_HOLD_SECONDS = Histogram(
+    'cookiebot_db_lock_hold_seconds', 'Time transactions held the database lock',
+    ('transaction',)
+)
+DB_LOAD_SECONDS = Histogram('cookiebot_db_load_seconds', 'Time taken to load the database')
+DB_SAVE_SECONDS = Histogram('cookiebot_db_save_seconds', 'Time taken to save a database snapshot')
+DB_WRITTEN_BYTES = Counter(
+    'cookiebot_db_written_bytes_total', 'Bytes written to the database and event log files',
+    ('file',)
+)
+DISCORD_REQUESTS = Counter(
+    'cookiebot_discord_requests_total', 'Messages sent, edited or responded to on discord',
+    ('kind',)
+)
+DISCORD_FAILURES = Counter(
+    'cookiebot_discord_failures_total', 'Discord requests that failed',
+    ('kind', 'reason')
+)
+TASK_TICK_SECONDS = Histogram(
+    'cookiebot_task_tick_seconds', 'Time taken by one run of a background task',
+    ('task',)
+)
+PARTICIPANTS = Gauge('cookiebot_participants', 'Number of people who have clicked the button')
+
+
+async def _handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'
+    })
+
+async def start_server(host: str, port: int) -> web.AppRunner:
+    """ Serve the metrics at http://host:port/metrics. Returns the runner to clean up with. """
+    app = web.Application()
+    app.router.add_get('/metrics', _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f'Serving metrics on http://{host}:{port}/metrics')
+    return runner
@@ -0,0 +1,45 @@
+class Ownership:
+    """ How many participants own each upgrade at each level, kept up to date as levels change
+        so ownership questions don't have to look at every participant. Level 0 isn't counted
+        as owning an upgrade. """
+
+    def __init__(self):
+        self._counts: dict[int, dict[int, int]] = {} # upgrade id -> {level: number of owners}
+        self._owners: dict[int, int] = {}
+        self._max_levels: dict[int, int] = {}
+
+    def add(self, upgrade_id: int, level: int):
+        """ Count a participant owning the upgrade at the given level """
+        if level <= 0:
+            return
+        counts = self._counts.setdefault(upgrade_id, {})
+        counts[level] = counts.get(level, 0) + 1
+        self._owners[upgrade_id] = self._owners.get(upgrade_id, 0) + 1
+        if level > self._max_levels.get(upgrade_id, 0):
+            self._max_levels[upgrade_id] = level
+
+    def remove(self, upgrade_id: int, level: int):
+        """ Stop counting a participant owning the upgrade at the given level """
+        if level <= 0:
+            return
+        counts = self._counts[upgrade_id]
+        counts[level] -= 1
+        self._owners[upgrade_id] -= 1
+        if counts[level] == 0:
+            del counts[level]
+            if level == self._max_levels[upgrade_id]:
+                # Only as many levels as are actually owned need to be looked at
+                self._max_levels[upgrade_id] = max(counts, default=0)
+
+    def change(self, upgrade_id: int, old_level: int, level: int):
+        """ Move a participant from one level of the upgrade to another """
+        self.remove(upgrade_id, old_level)
+        self.add(upgrade_id, level)
+
+    def max_level(self, upgrade_id: int) -> int:
+        """ Highest level anyone owns the upgrade at (0 if nobody owns it) """
+        return self._max_levels.get(upgrade_id, 0)
+
+    def owner_count(self, upgrade_id: int) -> int:
+        """ Number of participants who own the upgrade at any level """
+        return self._owners.get(upgrade_id, 0)
@@ -0,0 +1,64 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import tracemalloc
+
+_active = False
+
+
+def is_active() -> bool:
+    return _active
+
+
+async def capture(seconds: float, cpu: bool = True, memory: bool = False,
+                  limit: int = 50) -> str:
+    """ Profile everything running on the event loop for the given number of seconds and
+        return a text report. With cpu, functions are sorted by cumulative time (cProfile).
+        With memory, the lines that allocated the most memory still alive at the end are
+        listed (tracemalloc). Only one capture can run at a time. """
+    global _active
+    if _active:
+        raise RuntimeError('already profiling')
+    _active = True
+
+    profiler = cProfile.Profile() if cpu else None
+    started_tracemalloc = memory and not tracemalloc.is_tracing()
+    try:
+        if started_tracemalloc:
+            tracemalloc.start(10)
+        if profiler is not None:
+            profiler.enable()
+        await asyncio.sleep(seconds)
+        if profiler is not None:
+            profiler.disable()
+        snapshot = tracemalloc.take_snapshot() if memory else None
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        if started_tracemalloc:
+            tracemalloc.stop()
+        _active = False
+
+    report = io.StringIO()
+    report.write(f'Profiled for {seconds}s\n\n')
+    if profiler is not None:
+        report.write('=== CPU (cumulative time) ===\n')
+        stats = pstats.Stats(profiler, stream=report)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(limit)
+        report.write('=== CPU (own time) ===\n')
+        stats.sort_stats(pstats.SortKey.TIME).print_stats(limit)
+    if snapshot is not None:
+        # Leave out the profiler's own allocations
+        snapshot = snapshot.filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+        ])
+        top = snapshot.statistics('lineno')
+        total = sum(stat.size for stat in top)
+        report.write(f'=== Memory ({total / 1024:.1f} KiB allocated by traced lines) ===\n')
+        for stat in top[:limit]:
+            frame = stat.traceback[0]
+            report.write(f'{stat.size / 1024:>10.1f} KiB {stat.count:>8} blocks  '
+                         f'{frame.filename}:{frame.lineno}\n')
+    return report.getvalue()
@@ -0,0 +1,314 @@
+""" Offline load simulator. Plays a seeded random workload through the bot's real handlers,
+    with in-process stand-ins for discord's interactions, messages and channels.
+
+    python simulate.py                                  # 5 rounds on a 10k participant server
+    python simulate.py --clickers 500 --shoppers 100    # heavier rounds
+    python simulate.py --out sim.json                   # save the report
+
+    Each round the button's cooldown runs out and a storm of clickers hits it at once, while
+    shoppers spam the upgrade shop and others check their progress and stats. Every discord
+    call takes --latency seconds. The report has latency percentiles per handler, how long
+    transactions waited for the database lock, and how many times the database was written. """
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from bench import FakeUser, fetch_user, make_population
+from config import COOKIE_COOLDOWN, EVENT_LOG_FLUSH_RATE, USER_CACHE_SIZE, USER_CACHE_TTL, USER_FETCH_CONCURRENCY
+from cookiebot import BuyAmountSelect, CookieClicker, UpgradeSelect, bot
+from database import Database, UserTransaction
+from events import EventLog
+from users import UserResolver
+
+_message_ids = iter(range(1, 2 ** 62))
+
+
+class Stats:
+    """ Everything measured during a simulation """
+
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = {} # handler -> seconds per call
+        self.errors: dict[str, list[str]] = {} # handler -> error messages
+        self.lock_waits: dict[str, list[float]] = {'global': [], 'user': []}
+        self.journal_writes = 0
+        self.snapshot_writes = 0
+        self.messages_sent = 0
+        self.messages_edited = 0
+
+    def report(self) -> dict:
+        def percentiles(samples: list[float]) -> dict:
+            if not samples:
+                return dict(count=0)
+            samples = sorted(samples)
+            def at(p):
+                return samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000
+            return dict(count=len(samples), p50_ms=at(50), p90_ms=at(90), p99_ms=at(99),
+                        max_ms=samples[-1] * 1000, mean_ms=statistics.fmean(samples) * 1000)
+
+        return {
+            'handlers': {
+                name: dict(**percentiles(samples), errors=len(self.errors.get(name, [])))
+                for name, samples in sorted(self.latencies.items())
+            },
+            'lock_waits': {name: percentiles(samples) for name, samples in self.lock_waits.items()},
+            'journal_writes': self.journal_writes,
+            'snapshot_writes': self.snapshot_writes,
+            'messages_sent': self.messages_sent,
+            'messages_edited': self.messages_edited,
+        }
+
+
+stats = Stats()
+latency = 0.0
+
+
+async def _discord_call():
+    """ Every request to discord takes a while """
+    if latency > 0:
+        await asyncio.sleep(latency)
+
+
+class FakeChannel:
+    def __init__(self):
+        self.id = next(_message_ids)
+
+    async def send(self, content=None, **kwargs):
+        await _discord_call()
+        stats.messages_sent += 1
+        return FakeMessage(self, content=content, **kwargs)
+
+
+class FakeMessage:
+    def __init__(self, channel: FakeChannel, **kwargs):
+        self.id = next(_message_ids)
+        self.channel = channel
+        self.view = kwargs.get('view')
+
+    async def edit(self, **kwargs):
+        await _discord_call()
+        stats.messages_edited += 1
+        if 'view' in kwargs:
+            self.view = kwargs['view']
+
+
+class FakeResponse:
+    def __init__(self, interaction: 'FakeInteraction'):
+        self._interaction = interaction
+        self._done = False
+
+    def is_done(self) -> bool:
+        return self._done
+
+    async def send_message(self, content=None, **kwargs):
+        await _discord_call()
+        self._done = True
+        stats.messages_sent += 1
+        self._interaction.sent = FakeMessage(self._interaction.channel, content=content, **kwargs)
+
+    async def edit_message(self, **kwargs):
+        self._done = True
+        await self._interaction.message.edit(**kwargs)
+
+    async def defer(self, **kwargs):
+        await _discord_call()
+        self._done = True
+
+
+class FakeFollowup:
+    def __init__(self, channel: FakeChannel):
+        self._channel = channel
+
+    async def send(self, content=None, **kwargs):
+        return await self._channel.send(content, **kwargs)
+
+
+class FakeInteraction:
+    def __init__(self, user: FakeUser, message: FakeMessage | None, channel: FakeChannel):
+        self.user = user
+        self.message = message
+        self.channel = channel
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(channel)
+        self.sent: FakeMessage | None = None
+
+    def is_expired(self) -> bool:
+        return False
+
+    async def original_response(self) -> FakeMessage:
+        await _discord_call()
+        return self.sent
+
+
+def instrument():
+    """ Measure lock waits and database writes by wrapping the database classes """
+    def timed(enter, name):
+        async def wrapper(self):
+            start = time.perf_counter()
+            result = await enter(self)
+            stats.lock_waits[name].append(time.perf_counter() - start)
+            return result
+        return wrapper
+    Database.__aenter__ = timed(Database.__aenter__, 'global')
+    UserTransaction.__aenter__ = timed(UserTransaction.__aenter__, 'user')
+
+    commit = Database.commit
+    def counted_commit(self):
+        if self._pending:
+            stats.journal_writes += 1
+        commit(self)
+    Database.commit = counted_commit
+
+    write_snapshot = Database._write_snapshot
+    def counted_write_snapshot(self, data):
+        stats.snapshot_writes += 1
+        write_snapshot(self, data)
+    Database._write_snapshot = counted_write_snapshot
+
+
+async def handle(name: str, f, *args):
+    """ Run a handler and record how long it took """
+    start = time.perf_counter()
+    try:
+        await f(*args)
+    except Exception as e:
+        stats.errors.setdefault(name, []).append(f'{type(e).__name__}: {e}')
+    stats.latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+
+async def clicker(user: FakeUser, rng: random.Random, jitter: float):
+    await asyncio.sleep(rng.uniform(0, jitter))
+    view = CookieClicker()
+    interaction = FakeInteraction(user, bot.message, bot.message.channel)
+    await handle('click', view.click.callback, interaction)
+
+
+async def shopper(user: FakeUser, rng: random.Random, jitter: float, actions: int):
+    await asyncio.sleep(rng.uniform(0, jitter))
+    channel = bot.message.channel
+    interaction = FakeInteraction(user, bot.message, channel)
+    await handle('upgrades', bot.tree.get_command('upgrades').callback, interaction)
+    message = interaction.sent
+    if message is None:
+        return
+
+    for _ in range(actions):
+        await asyncio.sleep(rng.uniform(0, jitter))
+        interaction = FakeInteraction(user, message, channel)
+        shop = message.view
+        r = rng.random()
+        if r < 0.7:
+            select = next(item for item in shop.children if isinstance(item, UpgradeSelect))
+            select._values = [rng.choice(select.options).value]
+            await handle('upgrade_select', select.callback, interaction)
+        elif r < 0.85:
+            select = next(item for item in shop.children if isinstance(item, BuyAmountSelect))
+            select._values = [rng.choice(select.options).value]
+            await handle('buy_amount_select', select.callback, interaction)
+        else:
+            await handle('refresh', shop.refresh.callback, interaction)
+
+
+async def browser(user: FakeUser, rng: random.Random, jitter: float):
+    await asyncio.sleep(rng.uniform(0, jitter))
+    interaction = FakeInteraction(user, bot.message, bot.message.channel)
+    name = rng.choice(['progress', 'jar', 'stats', 'progress_button'])
+    if name == 'progress_button':
+        await handle(name, CookieClicker().progress.callback, interaction)
+    else:
+        await handle(name, bot.tree.get_command(name).callback, interaction)
+
+
+async def simulate(args, directory: str):
+    global latency
+    latency = args.latency
+    rng = random.Random(args.seed)
+    instrument()
+
+    db = Database(os.path.join(directory, 'db.json'))
+    db._from_json(make_population(args.participants, args.seed))
+    await db.save()
+    db.load()
+    async with db:
+        db.recompute_stats(bot.upgrades)
+
+    # Stand in for the discord client
+    bot.db = db
+    bot.user_resolver = UserResolver(lambda user_id: None, fetch_user,
+                                     USER_CACHE_TTL, USER_CACHE_SIZE, USER_FETCH_CONCURRENCY)
+    async def wait_until_ready():
+        pass
+    bot.wait_until_ready = wait_until_ready
+    await bot.set_clicker_message(FakeMessage(FakeChannel()))
+    bot.db_saver.start()
+    bot.events = EventLog(os.path.join(directory, 'events.jsonl'), EVENT_LOG_FLUSH_RATE)
+    bot.events.start()
+
+    user_ids = db.get_participants_user_ids()
+    for i in range(args.rounds):
+        # The cooldown just ran out
+        async with db:
+            db.set_last_clicked_time(datetime.utcnow() - timedelta(seconds=COOKIE_COOLDOWN))
+
+        start = time.perf_counter()
+        users = [FakeUser(user_id) for user_id in rng.sample(user_ids, args.clickers + args.shoppers + args.browsers)]
+        clickers = users[:args.clickers]
+        shoppers = users[args.clickers:args.clickers + args.shoppers]
+        browsers = users[args.clickers + args.shoppers:]
+        await asyncio.gather(
+            *(clicker(user, rng, args.jitter) for user in clickers),
+            *(shopper(user, rng, args.jitter, args.shop_actions) for user in shoppers),
+            *(browser(user, rng, args.jitter) for user in browsers),
+        )
+        print(f'round {i + 1}/{args.rounds} took {time.perf_counter() - start:.2f}s')
+
+    bot.db_saver.cancel()
+    bot.clicker_message_updater.stop()
+    await bot.events.stop()
+    await db.close()
+    return stats.report()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulate load on the bot without discord')
+    parser.add_argument('--participants', type=int, default=10_000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--clickers', type=int, default=300, help='clicks when the cooldown runs out')
+    parser.add_argument('--shoppers', type=int, default=50)
+    parser.add_argument('--shop-actions', type=int, default=10, help='actions each shopper takes')
+    parser.add_argument('--browsers', type=int, default=50, help='progress, jar and stats checks')
+    parser.add_argument('--jitter', type=float, default=0.5, help='seconds actions are spread over')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds each discord call takes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the report to this json file')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = asyncio.run(simulate(args, directory))
+    for name, result in report['handlers'].items():
+        if result['count']:
+            print(f'{name:<20} n={result["count"]:<6} p50 {result["p50_ms"]:>8.2f}ms  '
+                  f'p90 {result["p90_ms"]:>8.2f}ms  p99 {result["p99_ms"]:>8.2f}ms  '
+                  f'max {result["max_ms"]:>8.2f}ms  errors {result["errors"]}')
+    for name, errors in stats.errors.items():
+        print(f'{name} failed {len(errors)} times, first with {errors[0]}')
+    for name, result in report['lock_waits'].items():
+        if result['count']:
+            print(f'{name + " lock wait":<20} n={result["count"]:<6} p50 {result["p50_ms"]:>8.2f}ms  '
+                  f'p90 {result["p90_ms"]:>8.2f}ms  p99 {result["p99_ms"]:>8.2f}ms  '
+                  f'max {result["max_ms"]:>8.2f}ms')
+    print(f'journal writes {report["journal_writes"]}, snapshot writes {report["snapshot_writes"]}, '
+          f'messages sent {report["messages_sent"]}, edited {report["messages_edited"]}')
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+import asyncio
+import json
+import os
+import sqlite3
+import sys
+
+import metrics
+from database import Database
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS cookies (
+    user_id INTEGER PRIMARY KEY,
+    cookies TEXT NOT NULL,
+    settled INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS upgrades (
+    user_id INTEGER NOT NULL,
+    upgrade_id INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    PRIMARY KEY (user_id, upgrade_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stats (
+    user_id INTEGER PRIMARY KEY,
+    cpc TEXT,
+    cps TEXT
+);
+
+CREATE TABLE IF NOT EXISTS upgrade_messages (
+    message_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS upgrade_refresh_times (
+    user_id INTEGER PRIMARY KEY,
+    time TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS history (
+    user_id INTEGER PRIMARY KEY,
+    track TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS clicker (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+_CLICKER_KEYS = (
+    'clicker_message_id', 'clicker_channel_id',
+    'last_clicked_time', 'last_clicked_user_id', 'last_clicked_value',
+    'catalog_fingerprint',
+)
+
+
+class SQLiteDatabase(Database):
+    """ Database stored in SQLite (WAL mode) instead of a json file. It's a write-through
+        mirror: data is still kept in memory, and every mutation is written to just the rows it
+        touched. Nothing is queried after loading.
+
+        Ranks, the total and ownership used to be indexed SQL queries over a float copy of the
+        cookie count. Balances grow at each participant's own CPS, so no single column orders
+        them, and the in-memory leaderboard, aggregates and ownership counts answer these
+        without touching the disk.
+
+        Cookie counts and CPC/CPS can be far bigger than SQLite's 64-bit integers, so they're
+        stored as text. The cookies column is the base amount passive income accrues on top of
+        since the settled time (see Database.get_cookies). """
+
+    def __init__(self, filepath: str, journal_max_size: int = 1_000_000, backend: str = 'sqlite'):
+        super().__init__(filepath, journal_max_size, backend)
+        self._conn: sqlite3.Connection | None = None
+        self._pending: list[tuple[str, tuple]] = []
+
+    # --- IO --- #
+
+    def _record(self, op: str, *args):
+        """ Queue a mutation. Rows are written from the in-memory data when the transaction
+            ends (or before a query), so only the key of what changed matters here. """
+        self._pending.append((op, args))
+
+    def _write_pending(self):
+        """ Write rows touched by queued mutations, without committing """
+        for op, args in self._pending:
+            if op in ('settle', 'add_cookies'):
+                self._write_cookies(args[0])
+            elif op == 'set_stats':
+                self._write_stats(args[0])
+            elif op == 'set_upgrade_level':
+                user_id, upgrade_id, *_ = args
+                self._write_upgrade(user_id, upgrade_id)
+                self._write_stats(user_id)
+            elif op == 'delete_participant':
+                user_id = args[0]
+                self._conn.execute('DELETE FROM cookies WHERE user_id = ?', (user_id,))
+                self._conn.execute('DELETE FROM upgrades WHERE user_id = ?', (user_id,))
+                self._conn.execute('DELETE FROM stats WHERE user_id = ?', (user_id,))
+                self._write_clicker('last_clicked_user_id')
+                self._write_clicker('last_clicked_value')
+            elif op == 'set_upgrade_message_owner_id':
+                message_id, user_id = args
+                self._conn.execute('INSERT OR REPLACE INTO upgrade_messages VALUES (?, ?)',
+                                   (message_id, user_id))
+            elif op == 'clear_upgrade_message_owner_ids':
+                self._conn.execute('DELETE FROM upgrade_messages')
+            elif op == 'set_upgrade_refresh_time':
+                user_id, timestamp = args
+                self._conn.execute('INSERT OR REPLACE INTO upgrade_refresh_times VALUES (?, ?)',
+                                   (user_id, timestamp))
+            elif op.startswith('set_'):
+                self._write_clicker(op[4:])
+            else:
+                raise ValueError(f'unknown mutation: {op}')
+        self._pending.clear()
+
+    def _write_cookies(self, user_id: int):
+        p = self._users.get(user_id)
+        if p is None:
+            self._conn.execute('DELETE FROM cookies WHERE user_id = ?', (user_id,))
+        else:
+            self._conn.execute('INSERT OR REPLACE INTO cookies VALUES (?, ?, ?)',
+                               (user_id, str(p.cookies), p.settled))
+
+    def _write_upgrade(self, user_id: int, upgrade_id: int):
+        level = self.get_upgrade_level(user_id, upgrade_id)
+        if level == 0:
+            self._conn.execute('DELETE FROM upgrades WHERE user_id = ? AND upgrade_id = ?',
+                               (user_id, upgrade_id))
+        else:
+            self._conn.execute('INSERT OR REPLACE INTO upgrades VALUES (?, ?, ?)',
+                               (user_id, upgrade_id, level))
+
+    def _write_stats(self, user_id: int):
+        p = self._users.get(user_id)
+        cpc = p.cpc if p is not None else None
+        cps = p.cps if p is not None else None
+        if cpc is None and cps is None:
+            self._conn.execute('DELETE FROM stats WHERE user_id = ?', (user_id,))
+        else:
+            self._conn.execute('INSERT OR REPLACE INTO stats VALUES (?, ?, ?)', (
+                user_id,
+                None if cpc is None else str(cpc),
+                None if cps is None else str(cps),
+            ))
+
+    def _write_history(self):
+        """ Replace every balance history track. History changes with every balance change, so
+            it's only written on save and close, like the json backend's snapshot. """
+        self._conn.execute('DELETE FROM history')
+        self._conn.executemany('INSERT INTO history VALUES (?, ?)', (
+            (int(user_id), json.dumps(track, separators=(',', ':')))
+            for user_id, track in self._history.to_json().items()
+        ))
+
+    def _write_clicker(self, key: str):
+        self._conn.execute('INSERT OR REPLACE INTO clicker VALUES (?, ?)',
+                           (key, json.dumps(self._data[key])))
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending) or (self._conn is not None and self._conn.in_transaction)
+
+    def commit(self):
+        """ Write and commit all queued mutations """
+        if self._conn is None:
+            return
+        self._write_pending()
+        self._conn.commit()
+
+    async def flush(self, force=False):
+        """ Commit queued mutations, then checkpoint the WAL if it has grown past the size
+            limit (or if forced) """
+        if self._conn is None:
+            return
+        self.commit()
+        wal_filepath = self._filepath + '-wal'
+        if force or (os.path.exists(wal_filepath) and os.path.getsize(wal_filepath) >= self._journal_max_size):
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    @metrics.timed(metrics.DB_SAVE_SECONDS)
+    async def save(self):
+        """ Rewrite every table from the in-memory data """
+        self._pending.clear()
+        with self._conn:
+            for table in ('cookies', 'upgrades', 'stats', 'upgrade_messages', 'upgrade_refresh_times', 'clicker'):
+                self._conn.execute(f'DELETE FROM {table}')
+            for user_id, p in self._users.items():
+                self._write_cookies(user_id)
+                self._write_stats(user_id)
+                self._conn.executemany('INSERT INTO upgrades VALUES (?, ?, ?)', (
+                    (user_id, upgrade_id, level)
+                    for upgrade_id, level in enumerate(p.levels) if level
+                ))
+            self._conn.executemany('INSERT INTO upgrade_messages VALUES (?, ?)',
+                                   self._data['upgrade_message_owner_ids'].items())
+            self._conn.executemany('INSERT INTO upgrade_refresh_times VALUES (?, ?)',
+                                   self._data['upgrade_refresh_times'].items())
+            for key in _CLICKER_KEYS:
+                self._write_clicker(key)
+            self._write_history()
+
+    @metrics.timed(metrics.DB_LOAD_SECONDS)
+    def load(self):
+        """ Load the database from SQLite. The data stays in memory after this, so it only
+            needs to be called once at startup. """
+        if self._conn is None:
+            self._conn = sqlite3.connect(self._filepath)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(_SCHEMA)
+            self._drop_approx_column()
+        self._pending.clear()
+
+        data = {
+            'cookies': {},
+            'settled_times': {},
+            'upgrades': {},
+            'cpc_cache': {},
+            'cps_cache': {},
+            'upgrade_message_owner_ids': {
+                message_id: user_id
+                for message_id, user_id in self._conn.execute('SELECT * FROM upgrade_messages')
+            },
+            'upgrade_refresh_times': {
+                user_id: timestamp
+                for user_id, timestamp in self._conn.execute('SELECT * FROM upgrade_refresh_times')
+            },
+            'history': {
+                user_id: json.loads(track)
+                for user_id, track in self._conn.execute('SELECT * FROM history')
+            },
+        }
+        for user_id, cookies, settled in self._conn.execute('SELECT user_id, cookies, settled FROM cookies'):
+            data['cookies'][user_id] = int(cookies)
+            data['settled_times'][user_id] = settled
+        for user_id, upgrade_id, level in self._conn.execute('SELECT * FROM upgrades'):
+            data['upgrades'].setdefault(user_id, {})[upgrade_id] = level
+        for user_id, cpc, cps in self._conn.execute('SELECT * FROM stats'):
+            if cpc is not None:
+                data['cpc_cache'][user_id] = int(cpc)
+            if cps is not None:
+                data['cps_cache'][user_id] = int(cps)
+        for key, value in self._conn.execute('SELECT * FROM clicker'):
+            data[key] = json.loads(value)
+        self._from_json(data)
+        self._rebuild_indexes()
+
+    def _drop_approx_column(self):
+        """ Databases made by older versions kept a float copy of the cookie count, which
+            nothing reads anymore """
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(cookies)')]
+        if 'cookies_approx' in columns:
+            with self._conn:
+                self._conn.execute('DROP INDEX IF EXISTS cookies_approx_index')
+                self._conn.execute('ALTER TABLE cookies DROP COLUMN cookies_approx')
+
+    async def close(self):
+        """ Commit everything and close the connection """
+        if self._conn is not None:
+            with self._conn:
+                self._write_history()
+            await self.flush(force=True)
+            self._conn.close()
+            self._conn = None
+
+
+async def migrate_json(json_filepath: str, sqlite_filepath: str):
+    """ One-shot copy of a json database (snapshot plus journal) into a SQLite database """
+    src = Database(json_filepath)
+    src.load()
+    dst = Database(sqlite_filepath, backend='sqlite')
+    dst.load()
+    dst._from_json(src._to_json())
+    await dst.save()
+    await dst.close()
+    await src.close()
+
+
+if __name__ == '__main__':
+    # python sqlite_database.py data/db.json data/db.sqlite3
+    asyncio.run(migrate_json(sys.argv[1], sys.argv[2]))
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable
+
+log = logging.getLogger('bot')
+
+
+class DebouncedUpdater:
+    """ Runs an update in the background every `interval` seconds, and soon after whenever one
+        is requested. Requests that come in while waiting are merged into a single update, and
+        updates never run closer together than `debounce` seconds (or the back off time after
+        being rate limited). The update itself should render the latest state when it runs, so
+        a burst of requests only ever sends the newest one. """
+
+    def __init__(self, update: Callable[[], Awaitable[None]], interval: float, debounce: float):
+        self._update = update
+        self._interval = interval
+        self._debounce = debounce
+        self._requested = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._running = False
+        self._next_time = 0.0 # loop time before which no update can run
+
+    def start(self):
+        """ Start running updates """
+        if self.is_running():
+            return
+        self._running = True
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        """ Stop running updates. Can be called from inside the update. """
+        self._running = False
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+
+    def is_running(self) -> bool:
+        return self._running
+
+    def request(self):
+        """ Ask for an update as soon as the debounce window and rate limits allow """
+        self._requested.set()
+
+    def back_off(self, seconds: float):
+        """ Don't run another update for the given number of seconds (e.g. after a 429, or to
+            spread out what's left of a rate limit) """
+        loop = asyncio.get_running_loop()
+        self._next_time = max(self._next_time, loop.time() + seconds)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        log.debug(f'Updater started. ({self._interval}s, debounce {self._debounce}s)')
+        try:
+            while self._running:
+                try:
+                    await asyncio.wait_for(self._requested.wait(), self._interval)
+                except asyncio.TimeoutError:
+                    pass
+
+                # Let more requests pile up, and stay within the edit budget
+                await asyncio.sleep(max(self._debounce, self._next_time - loop.time()))
+                if not self._running:
+                    break
+                self._requested.clear()
+                self._next_time = loop.time() + self._debounce
+                try:
+                    await self._update()
+                except Exception:
+                    log.exception('Update failed')
+        finally:
+            log.debug('Updater stopped.')
@@ -1,36 +1,111 @@
+import hashlib
 from abc import ABC, abstractmethod
+from bisect import bisect_right
+from itertools import accumulate
 
-from config import SWINDLE_AMOUNT
+from config import SWINDLE_AMOUNT, UPGRADE_MAX_LEVEL
 from util import bignum, percent
 
 _id_counter = 0
 
 
+def reset_ids():
+    """ Start numbering upgrades from 0 again, for building a new list of upgrades """
+    global _id_counter
+    _id_counter = 0
+
+def fingerprint(upgrades: list['Upgrade']) -> str:
+    """ Hash of everything about the given upgrades that derived stats depend on. The functions
+        behind an upgrade can't be compared directly, so their precomputed values at every
+        level are. """
+    h = hashlib.sha256()
+    for u in upgrades:
+        h.update(f'{u.id}:{type(u).__name__}:{u.max_level}\n'.encode())
+        h.update(repr((u._cpc, u._cps, u._probabilities, u._prices)).encode())
+    return h.hexdigest()
+
+
 class Upgrade(ABC):
-    def __init__(self, emoji: str, name: str, hide: bool):
+    def __init__(self, emoji: str, name: str, price_func, hide: bool):
         self.emoji = emoji
         self.name = name
         self.hide = hide
+        self.price_func = price_func
         global _id_counter
         self.id = _id_counter
         _id_counter += 1
 
+        # Everything per level is computed once up front, up to the highest level the upgrade
+        # can be bought to. Index 0 is level 0, which has no price and gives nothing.
+        self.max_level = min(getattr(price_func, 'max_level', UPGRADE_MAX_LEVEL), UPGRADE_MAX_LEVEL)
+        levels = range(1, self.max_level + 1)
+        self._prices = [0, *(price_func(level) for level in levels)]
+        self._spent = list(accumulate(self._prices))
+        self._cpc = [0, *(self._cookies_per_click(level) for level in levels)]
+        self._cps = [0, *(self._cookies_per_second(level) for level in levels)]
+        self._probabilities = [0, *(self._swindle_probability(level) for level in levels)]
+
+    def _cookies_per_click(self, level: int) -> int:
+        return 0
+
+    def _cookies_per_second(self, level: int) -> int:
+        return 0
+
+    def _swindle_probability(self, level: int) -> float:
+        return 0
+
     def get_cookies_per_click(self, level: int) -> int:
         """ Cookies per click given by this upgrade at the given level """
-        return 0
+        if level <= 0:
+            return 0
+        if level <= self.max_level:
+            return self._cpc[level]
+        return self._cookies_per_click(level)
 
     def get_cookies_per_second(self, level: int) -> int:
         """ Cookies per second second given by this upgrade at the given level """
-        return 0
+        if level <= 0:
+            return 0
+        if level <= self.max_level:
+            return self._cps[level]
+        return self._cookies_per_second(level)
 
     def get_swindle_probability(self, level: int) -> float:
         """ Probability of swindling that this upgrade gives at the given level (0.0 to 1.0) """
-        return 0
+        if level <= 0:
+            return 0
+        if level <= self.max_level:
+            return self._probabilities[level]
+        return self._swindle_probability(level)
 
-    @abstractmethod
-    def get_price(self, level: int) -> int:
-        """ Price of the the upgrade at the given level """
-        pass
+    def get_price(self, level: int) -> int | None:
+        """ Price of the the upgrade at the given level (None above max_level, where it can't
+            be bought) """
+        if level <= 0:
+            return 0
+        if level <= self.max_level:
+            return self._prices[level]
+        return None
+
+    def get_spent(self, level: int) -> int:
+        """ Total price of every level up to and including the given one. Levels above
+            max_level can only be given with /give_upgrade and were never paid for, so they
+            don't add anything. """
+        return self._spent[max(0, min(level, self.max_level))]
+
+    def get_bulk_price(self, level: int, n: int) -> int | None:
+        """ Total price of buying n more levels on top of the given level (None if it can't be
+            bought that high) """
+        if n <= 0 or level < 0 or level + n > self.max_level:
+            return None
+        return self._spent[level + n] - self._spent[level]
+
+    def get_max_affordable(self, level: int, balance: int) -> int:
+        """ Most levels that can be bought on top of the given level with the given balance """
+        if level < 0 or level >= self.max_level:
+            return 0
+        # Prices are never negative, so the prefix sums are sorted
+        return max(0, bisect_right(self._spent, self._spent[level] + balance) - 1 - level)
 
     @abstractmethod
     def get_value_str(self, level: int, hide=False) -> str:
@@ -46,20 +121,12 @@ class Upgrade(ABC):
 
 class ClickUpgrade(Upgrade):
     def __init__(self, emoji, name, cpc_func, price_func, hide=False):
-        super().__init__(emoji, name, hide)
         self.cpc_func = cpc_func
-        self.price_func = price_func
+        super().__init__(emoji, name, price_func, hide)
 
-    def get_cookies_per_click(self, level):
-        if level <= 0:
-            return 0
+    def _cookies_per_click(self, level):
         return self.cpc_func(level)
 
-    def get_price(self, level):
-        if level <= 0:
-            return 0
-        return self.price_func(level)
-
     def get_value_str(self, level: int, hide=False) -> str:
         if hide and self.hide:
             return '+??? / click'
@@ -68,20 +135,12 @@ class ClickUpgrade(Upgrade):
 
 class PassiveUpgrade(Upgrade):
     def __init__(self, emoji, name, cps_func, price_func, hide=False):
-        super().__init__(emoji, name, hide)
         self.cps_func = cps_func
-        self.price_func = price_func
+        super().__init__(emoji, name, price_func, hide)
 
-    def get_cookies_per_second(self, level):
-        if level <= 0:
-            return 0
+    def _cookies_per_second(self, level):
         return self.cps_func(level)
 
-    def get_price(self, level):
-        if level <= 0:
-            return 0
-        return self.price_func(level)
-
     def get_value_str(self, level: int, hide=False) -> str:
         if hide and self.hide:
             return '+??? / sec'
@@ -91,20 +150,12 @@ class PassiveUpgrade(Upgrade):
 
 class SwindleUpgrade(Upgrade):
     def __init__(self, emoji, name, prob_func, price_func, hide=False):
-        super().__init__(emoji, name, hide)
         self.prob_func = prob_func
-        self.price_func = price_func
+        super().__init__(emoji, name, price_func, hide)
 
-    def get_swindle_probability(self, level: int):
-        if level <= 0:
-            return 0
+    def _swindle_probability(self, level: int):
         return self.prob_func(level)
 
-    def get_price(self, level: int) -> int:
-        if level <= 0:
-            return 0
-        return self.price_func(level)
-
     def get_value_str(self, level: int, hide=False) -> str:
         if level <= 1 and self.hide: # hide only first level
             return '???'
@@ -132,5 +183,5 @@ def print_upgrade_values(upgrades, to_level):
                 val = percent(u.get_swindle_probability(lvl))
             else:
                 val = '?'
-            print('{:<8} {:<25} {}'.format(lvl, bignum(price), val))
+            print('{:<8} {:<25} {}'.format(lvl, bignum(price) if price is not None else 'MAX', val))
         print()
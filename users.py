@@ -0,0 +1,72 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Iterable
+
+from discord import User
+
+
+class UserResolver:
+    """ Looks up users to show on messages. Users already in the client's cache are used as is.
+        Anyone else is fetched, with several fetches running at once, and kept in an LRU cache
+        for a while so names still update eventually. """
+
+    def __init__(self, lookup: Callable[[int], User | None], fetch: Callable[[int], Awaitable[User]],
+                 ttl: float, max_size: int, concurrency: int):
+        self._lookup = lookup
+        self._fetch = fetch
+        self._ttl = ttl
+        self._max_size = max_size
+        self._cache: OrderedDict[int, tuple[float, User]] = OrderedDict() # user id -> (expiry, user)
+        self._fetching: dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def get(self, user_id: int) -> User:
+        """ Get a single user """
+        return (await self.get_many([user_id]))[user_id]
+
+    async def get_many(self, user_ids: Iterable[int]) -> dict[int, User]:
+        """ Get all of the given users at once, as a dict of user id -> user """
+        users = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            user = self._get_cached(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                users[user_id] = user
+        if missing:
+            fetched = await asyncio.gather(*(self._get_fetched(user_id) for user_id in missing))
+            users.update(zip(missing, fetched))
+        return users
+
+    def _get_cached(self, user_id: int) -> User | None:
+        user = self._lookup(user_id)
+        if user is not None:
+            return user
+        entry = self._cache.get(user_id)
+        if entry is None:
+            return None
+        expiry, user = entry
+        if expiry < time.monotonic():
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return user
+
+    async def _get_fetched(self, user_id: int) -> User:
+        # Renders running at the same time share the fetch instead of each making their own
+        task = self._fetching.get(user_id)
+        if task is None:
+            task = self._fetching[user_id] = asyncio.create_task(self._fetch_one(user_id))
+            task.add_done_callback(lambda _: self._fetching.pop(user_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_one(self, user_id: int) -> User:
+        async with self._semaphore:
+            user = await self._fetch(user_id)
+        self._cache[user_id] = (time.monotonic() + self._ttl, user)
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > self._max_size:
+            self._cache.popitem(last=False)
+        return user
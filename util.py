@@ -1,13 +1,20 @@
+import asyncio
 import functools
+import hashlib
+import json
 import math
+import time
+from fractions import Fraction
 
-from discord import DiscordException, Interaction
+from discord import DiscordException, Embed, HTTPException, Interaction
+from discord.ui import View
 
+import metrics
 from config import BIGNUM_PLACES
 
 
 class Break(Exception):
-    """ If this exception is raised inside an `async with bot.db`, the database will be saved,
+    """ If this exception is raised inside an `async with bot.db`, it will be suppressed,
         unlike with other exceptions. """
     pass
 
@@ -17,28 +24,69 @@ class InteractionResponse(Break):
             with the given message. Message can be a string or a dict passed to send_message() """
         self.message = message
 
+async def uncancellable(aw):
+    """ Await something that has to run to the end, like a worker thread writing a file. If
+        the caller is cancelled meanwhile, it still waits for it to finish and then raises
+        the cancellation. """
+    task = asyncio.ensure_future(aw)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            cancelled = True
+    result = task.result()
+    if cancelled:
+        raise asyncio.CancelledError
+    return result
+
 def catch_errors(f):
     """ Decorator that catches errors and responds to interactions with the error message.
-        If the raised error is not a util.InteractionResponse, the error will be raised again. """
+        If the raised error is not a util.InteractionResponse, the error will be raised again.
+        How long the handler took is recorded in the metrics. """
     @functools.wraps(f)
     async def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'ok'
         try:
             return await f(*args, **kwargs)
         except InteractionResponse as e:
+            outcome = 'response'
             await _interaction_respond(args, e.message)
         except Exception as e:
+            outcome = 'error'
+            if isinstance(e, HTTPException) and not getattr(e, 'counted', False):
+                metrics.DISCORD_FAILURES.inc(kind='interaction', reason=e.status)
             msg = f"```{type(e).__name__}: {str(e)}```"
             await _interaction_respond(args, msg)
             raise e from None
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - start, handler=f.__qualname__, outcome=outcome)
+            i = _get_interaction(args)
+            if i is not None and i.response.is_done():
+                metrics.DISCORD_REQUESTS.inc(kind='interaction')
     return wrapper
 
-async def _interaction_respond(args, msg):
-    i: Interaction | None = None
+async def discord_request(kind: str, aw):
+    """ Await a discord request other than the interaction response (which @catch_errors
+        counts), counting it and any failure in the metrics as the given kind """
+    metrics.DISCORD_REQUESTS.inc(kind=kind)
+    try:
+        return await aw
+    except HTTPException as e:
+        metrics.DISCORD_FAILURES.inc(kind=kind, reason=e.status)
+        e.counted = True
+        raise
+
+def _get_interaction(args) -> Interaction | None:
     if len(args) > 0 and isinstance(args[0], Interaction):
-        i = args[0]
+        return args[0]
     elif len(args) > 1 and isinstance(args[1], Interaction):
-        i = args[1]
+        return args[1]
+    return None
 
+async def _interaction_respond(args, msg):
+    i = _get_interaction(args)
     if i is None:
         return
     if i.is_expired():
@@ -52,24 +100,37 @@ async def _interaction_respond(args, msg):
     else:
         await i.response.send_message(**msg)
 
+def payload_digest(content: str | None = None, embed: Embed | None = None, view: View | None = None) -> str:
+    """ Hash of how a message would look with the given content, embed and view. If it's the
+        same as the last one, editing the message wouldn't change anything. """
+    payload = [
+        content,
+        embed.to_dict() if embed is not None else None,
+        [item.to_component_dict() for item in view.children] if view is not None else None,
+    ]
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
 
 def exp(coeff, base):
-    """ returns an exponential function f(x) = coeff * base ^ (x-1) """
-    @functools.cache
+    """ returns an exponential function f(x) = coeff * base ^ (x-1), rounded to an exact int """
+    coeff, base = Fraction(coeff), Fraction(base)
     def f(lvl):
-        return round(coeff * pow(base, lvl - 1))
+        return round(coeff * base ** (lvl - 1))
     return f
 
 def lin(yint, slope):
     """ returns a linear function f(x) = yint + (x-1) * slope """
-    @functools.cache
     def f(lvl):
         return yint + (lvl - 1) * slope
     return f
 
 def cap(f, max_lvl):
-    """ returns a function with an input cap on f """
-    return lambda lvl: f(lvl) if lvl <= max_lvl else math.inf
+    """ returns a function with an input cap on f. Used as a price, max_lvl is the highest
+        level the upgrade can be bought to, and there's no price (None) above it. """
+    def g(lvl):
+        return f(lvl) if lvl <= max_lvl else None
+    g.max_level = max_lvl
+    return g
 
 def time_str(s):
     seconds = math.ceil(s)